@@ -0,0 +1,39 @@
+"""add (chat_id, time_sent, id) index to messages
+
+Revision ID: 5b1e0c7d9a42
+Revises: c4de6224c78d
+Create Date: 2026-10-17 10:02:11.418203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1e0c7d9a42'
+down_revision: Union[str, Sequence[str], None] = 'c4de6224c78d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # CONCURRENTLY builds the index without blocking inserts, but it can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_messages_chat_id_time_sent_id', 'messages', ['chat_id', 'time_sent', 'id'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True
+        )
+        # ix_messages_id duplicates the primary key, ix_messages_chat_id is a prefix of the new index
+        op.drop_index(op.f('ix_messages_id'), table_name='messages', postgresql_concurrently=True, if_exists=True)
+        op.drop_index(op.f('ix_messages_chat_id'), table_name='messages', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_messages_chat_id'), 'messages', ['chat_id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index(op.f('ix_messages_id'), 'messages', ['id'], unique=False, postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index('ix_messages_chat_id_time_sent_id', table_name='messages', postgresql_concurrently=True, if_exists=True)
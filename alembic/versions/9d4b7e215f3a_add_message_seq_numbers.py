@@ -0,0 +1,52 @@
+"""add per-chat message sequence numbers
+
+Revision ID: 9d4b7e215f3a
+Revises: e83f2a61c4b7
+Create Date: 2026-10-17 15:02:11.408227
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4b7e215f3a'
+down_revision: Union[str, Sequence[str], None] = 'e83f2a61c4b7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('seq', sa.BigInteger(), nullable=True))
+    op.add_column('chat_summaries', sa.Column('last_seq', sa.BigInteger(), server_default='0', nullable=False))
+
+    # number existing messages 1..n per chat in send order, and carry on from there
+    op.execute("""
+        UPDATE messages m SET seq = numbered.seq
+        FROM (
+            SELECT id, row_number() OVER (PARTITION BY chat_id ORDER BY time_sent, id) AS seq
+            FROM messages
+        ) numbered
+        WHERE m.id = numbered.id
+    """)
+    op.execute("""
+        UPDATE chat_summaries s
+        SET last_seq = coalesce((SELECT max(m.seq) FROM messages m WHERE m.chat_id = s.chat_id), 0)
+    """)
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_messages_chat_id_seq', 'messages', ['chat_id', 'seq'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_messages_chat_id_seq', table_name='messages', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('chat_summaries', 'last_seq')
+    op.drop_column('messages', 'seq')
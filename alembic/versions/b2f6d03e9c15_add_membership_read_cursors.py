@@ -0,0 +1,36 @@
+"""add read cursors to memberships
+
+Revision ID: b2f6d03e9c15
+Revises: 9d4b7e215f3a
+Create Date: 2026-10-17 23:10:42.195306
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b2f6d03e9c15'
+down_revision: Union[str, Sequence[str], None] = '9d4b7e215f3a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chat_memberships', sa.Column('last_read_seq', sa.BigInteger(), server_default='0', nullable=False))
+
+    # nobody has read receipts yet - start everyone caught up rather than with their whole history unread
+    op.execute("""
+        UPDATE chat_memberships m
+        SET last_read_seq = s.last_seq
+        FROM chat_summaries s
+        WHERE s.chat_id = m.chat_id
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('chat_memberships', 'last_read_seq')
@@ -0,0 +1,38 @@
+"""add client message ids
+
+Revision ID: c7e1a4f2d958
+Revises: b2f6d03e9c15
+Create Date: 2026-10-17 23:48:05.603117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e1a4f2d958'
+down_revision: Union[str, Sequence[str], None] = 'b2f6d03e9c15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('messages', sa.Column('client_msg_id', sa.String(length=64), nullable=True))
+
+    # partial - existing rows and clients that don't send ids stay out of it
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ux_messages_creator_id_client_msg_id', 'messages', ['creator_id', 'client_msg_id'],
+            unique=True, postgresql_where=sa.text('client_msg_id IS NOT NULL'),
+            postgresql_concurrently=True, if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index('ux_messages_creator_id_client_msg_id', table_name='messages', postgresql_concurrently=True, if_exists=True)
+    op.drop_column('messages', 'client_msg_id')
@@ -0,0 +1,47 @@
+"""64-bit snowflake message ids
+
+Revision ID: d41a9c6e0b27
+Revises: c7e1a4f2d958
+Create Date: 2026-10-18 00:21:37.880412
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41a9c6e0b27'
+down_revision: Union[str, Sequence[str], None] = 'c7e1a4f2d958'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # rewrites the table under an exclusive lock - run it in a quiet window on a big messages table.
+    # existing serial ids stay as they are, every snowflake is bigger than them, so the order holds
+    op.alter_column('messages', 'id', type_=sa.BigInteger(), existing_type=sa.Integer(), existing_nullable=False)
+    op.alter_column('chat_summaries', 'last_message_id', type_=sa.BigInteger(), existing_type=sa.Integer(), existing_nullable=True)
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_messages_chat_id_id', 'messages', ['chat_id', 'id'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True
+        )
+        # history and latest-N key on id now, nothing reads (chat_id, time_sent, id) any more
+        op.drop_index('ix_messages_chat_id_time_sent_id', table_name='messages', postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'ix_messages_chat_id_time_sent_id', 'messages', ['chat_id', 'time_sent', 'id'],
+            unique=False, postgresql_concurrently=True, if_not_exists=True
+        )
+        op.drop_index('ix_messages_chat_id_id', table_name='messages', postgresql_concurrently=True, if_exists=True)
+    # fails once snowflake ids are stored - they don't fit in an INTEGER
+    op.alter_column('chat_summaries', 'last_message_id', type_=sa.Integer(), existing_type=sa.BigInteger(), existing_nullable=True)
+    op.alter_column('messages', 'id', type_=sa.Integer(), existing_type=sa.BigInteger(), existing_nullable=False)
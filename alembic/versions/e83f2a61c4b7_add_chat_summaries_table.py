@@ -0,0 +1,58 @@
+"""add chat_summaries table
+
+Revision ID: e83f2a61c4b7
+Revises: 5b1e0c7d9a42
+Create Date: 2026-10-17 11:24:37.902114
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e83f2a61c4b7'
+down_revision: Union[str, Sequence[str], None] = '5b1e0c7d9a42'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('chat_summaries',
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('message_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('member_count', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('last_message_id', sa.Integer(), nullable=True),
+    sa.Column('last_message_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('last_activity_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('chat_id')
+    )
+    op.create_index(op.f('ix_chat_summaries_last_activity_at'), 'chat_summaries', ['last_activity_at'], unique=False)
+
+    # backfill one row per existing chat
+    op.execute("""
+        INSERT INTO chat_summaries (chat_id, message_count, member_count, last_message_id, last_message_at, last_activity_at)
+        SELECT
+            c.id,
+            (SELECT count(*) FROM messages m WHERE m.chat_id = c.id),
+            (SELECT count(*) FROM chat_memberships cm WHERE cm.chat_id = c.id),
+            last_message.id,
+            last_message.time_sent,
+            coalesce(last_message.time_sent, now())
+        FROM chats c
+        LEFT JOIN LATERAL (
+            SELECT m.id, m.time_sent FROM messages m
+            WHERE m.chat_id = c.id
+            ORDER BY m.time_sent DESC, m.id DESC
+            LIMIT 1
+        ) last_message ON true
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_chat_summaries_last_activity_at'), table_name='chat_summaries')
+    op.drop_table('chat_summaries')
@@ -0,0 +1,62 @@
+"""
+Auth overhead per request, with and without the verified-token cache.
+
+Calls get_current_user_id - what every authenticated REST route runs - the way
+FastAPI does, with --tokens different users' tokens taking turns:
+  uncached   -> JWT_CACHE_MAX_ENTRIES=0, a full jwt.decode every time (the old path)
+  cached     -> after each token's first request, a digest + LRU lookup
+  cache full -> cache smaller than --tokens, so every request misses and evicts (worst case)
+
+Run from the repo root:
+    python -m benchmarks.bench_auth_cache [--requests 200000] [--tokens 1000] [--json results.json]
+"""
+import argparse, json, os, time
+
+os.environ.setdefault("SECRET_KEY", "benchmark") # utils.auth reads it on import
+
+from fastapi.security import HTTPAuthorizationCredentials
+
+from utils.auth import create_access_token, get_current_user_id
+from utils.token_cache import verified_tokens
+
+
+def per_request_us(credentials, requests, max_entries):
+    verified_tokens.max_entries = max_entries
+    verified_tokens.clear()
+    started = time.perf_counter()
+    for i in range(requests):
+        get_current_user_id(credentials[i % len(credentials)])
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+def run(requests, tokens):
+    credentials = [
+        HTTPAuthorizationCredentials(scheme="Bearer", credentials=create_access_token({"user_id" : user_id}))
+        for user_id in range(1, tokens + 1)
+    ]
+    return {
+        "uncached" : per_request_us(credentials, requests, 0),
+        "cached" : per_request_us(credentials, requests, tokens),
+        "cache_full" : per_request_us(credentials, requests, max(1, tokens // 2)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--tokens", type=int, default=1000)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = run(args.requests, args.tokens)
+
+    for name, us in results.items():
+        print(f"{name:>10} | {us:8.2f}us per request | {results['uncached'] / us:6.1f}x uncached")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"requests" : args.requests, "tokens" : args.tokens, "us_per_request" : results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Immediate vs coalesced delivery for a busy room.
+
+Drives one room of fake sockets through a real ConnectionManager (in-memory
+broker, no database) at a fixed event rate, once with coalescing off and once
+with it on, and reports CPU per event, frames written and delivery latency.
+Each fake socket writes its frames to /dev/null so every frame costs a real
+syscall, like a send on a TCP socket would.
+
+Run from the repo root:
+    python -m benchmarks.bench_coalescing [--room 200] [--rate 500] [--seconds 3] [--window-ms 20] [--json results.json]
+"""
+import argparse, asyncio, json, os, time
+from datetime import datetime
+
+import pytz
+
+os.environ.setdefault("SECRET_KEY", "benchmark") # routes.websocket pulls in utils.auth
+os.environ.setdefault("DATABASE_URL", "sqlite://") # never queried, the broker has no seq reserver
+
+from routes.websocket import ConnectionManager
+from utils.broker import InMemoryBroker
+from utils.outbound import Connection
+
+
+class NullWebSocket:
+    """Just enough of a WebSocket for Connection's writer."""
+
+    def __init__(self, fd : int, probe : bool = False):
+        self.fd = fd
+        self.probe = probe # only one socket decodes its frames for latency, so decoding doesn't swamp the CPU numbers
+        self.frames = 0
+        self.latencies = [] # seconds from publish to write, per event
+
+    async def send_text(self, data : str):
+        self._write(data.encode())
+
+    async def send_bytes(self, data : bytes):
+        self._write(data)
+
+    def _write(self, data : bytes):
+        os.write(self.fd, data)
+        self.frames += 1
+        if self.probe:
+            now = time.perf_counter()
+            event = json.loads(data)
+            for sent in event["events"] if event["type"] == "batch" else [event]:
+                if "sent_at" in sent: # not the presence snapshot every join gets
+                    self.latencies.append(now - sent["sent_at"])
+
+    async def close(self, code : int = 1000, reason : str = ""):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0
+
+
+async def run_mode(room_size, rate, seconds, coalesce_rate, window_ms, fd):
+    manager = ConnectionManager(InMemoryBroker(), coalesce_rate=coalesce_rate, coalesce_window_ms=window_ms)
+    await manager.start()
+
+    sockets = [NullWebSocket(fd, probe=(i == 0)) for i in range(room_size)]
+    connections = []
+    for websocket in sockets:
+        connection = Connection(websocket, max_queue=100000)
+        connection.start()
+        await manager.join(connection, 1)
+        connections.append(connection)
+
+    timestamp = datetime.now(tz=pytz.timezone("Australia/Brisbane")).isoformat()
+    total = int(rate * seconds)
+    interval = 1 / rate
+    started_cpu, started = time.process_time(), time.perf_counter()
+    for i in range(total):
+        await manager.broadcast({
+            "type" : "message",
+            "chat_id" : 1,
+            "sender" : "bench",
+            "content" : f"message {i}",
+            "timestamp" : timestamp,
+            "sent_at" : time.perf_counter()
+        }, 1)
+        # keep to the target rate on average
+        delay = started + (i + 1) * interval - time.perf_counter()
+        await asyncio.sleep(max(delay, 0))
+
+    # let the last batch and every queue drain
+    await asyncio.sleep(window_ms / 1000 * 2 + 0.05)
+    while any(c.queue for c in connections):
+        await asyncio.sleep(0.01)
+    cpu = time.process_time() - started_cpu
+
+    for connection in connections:
+        await connection.stop()
+    await manager.stop()
+
+    latencies = sockets[0].latencies
+    frames = sum(websocket.frames for websocket in sockets)
+    return {
+        "events" : total,
+        "frames" : frames,
+        "events_per_frame" : round(total * room_size / frames, 2) if frames else 0,
+        "cpu_us_per_event" : round(cpu / total * 1e6, 1),
+        "latency_ms" : {p : round(percentile(latencies, p) * 1000, 2) for p in (50, 95, 99)},
+    }
+
+
+async def run(room_size, rate, seconds, window_ms):
+    fd = os.open(os.devnull, os.O_WRONLY)
+    try:
+        return {
+            "immediate" : await run_mode(room_size, rate, seconds, 0, window_ms, fd),
+            "coalesced" : await run_mode(room_size, rate, seconds, 1, window_ms, fd), # threshold 1/s -> always on
+        }
+    finally:
+        os.close(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--room", type=int, default=200, help="sockets in the room")
+    parser.add_argument("--rate", type=float, default=500, help="events per second")
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--window-ms", type=int, default=20)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.room, args.rate, args.seconds, args.window_ms))
+
+    for mode, row in results.items():
+        latency = ", ".join(f"p{p} {v}ms" for p, v in row["latency_ms"].items())
+        print(f"{mode:>9} | {row['cpu_us_per_event']:,.1f}us cpu/event | {row['frames']:,} frames ({row['events_per_frame']} events/frame) | {latency}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args" : vars(args), "results" : results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
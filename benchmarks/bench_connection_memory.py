@@ -0,0 +1,108 @@
+"""
+Memory per websocket connection, and the cost of emptying a big room.
+
+Builds --connections Connections (with their writer tasks) in one process and
+registers them with a ConnectionManager, spread over rooms of --room-size, then:
+  bytes per connection  -> Python allocations (tracemalloc) and RSS growth, divided by connections
+  mass leave            -> time to disconnect every socket in one room, one at a time
+
+Run from the repo root:
+    python -m benchmarks.bench_connection_memory [--connections 100000] [--room-size 10000] [--json results.json]
+"""
+import argparse, asyncio, contextlib, io, json, os, random, resource, time, tracemalloc
+
+os.environ.setdefault("SECRET_KEY", "benchmark") # routes.websocket pulls in utils.auth
+os.environ.setdefault("DATABASE_URL", "sqlite://") # never queried
+
+from routes.websocket import ConnectionManager
+from utils.broker import InMemoryBroker
+from utils.outbound import Connection
+
+
+class IdleWebSocket:
+    """Never sent anything - the sockets just sit in their rooms."""
+
+    async def send_text(self, data):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+    async def close(self, code : int = 1000, reason : str = ""):
+        pass
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError: # not Linux, fall back to the peak
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def run(connections : int, room_size : int) -> dict:
+    manager = ConnectionManager(InMemoryBroker(), heartbeat_interval=0)
+    await manager.start()
+    await asyncio.sleep(0)
+
+    rss_before = rss_bytes()
+    tracemalloc.start()
+    traced_before = tracemalloc.get_traced_memory()[0]
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # join prints a line per socket
+        for i in range(connections):
+            connection = Connection(IdleWebSocket())
+            connection.start()
+            connection.user_id = i
+            connection.username = f"user{i}"
+            manager.connections.add(connection)
+            await manager.join(connection, i // room_size)
+    await asyncio.sleep(0) # let every writer task start and park
+    build_s = time.perf_counter() - started
+
+    traced = tracemalloc.get_traced_memory()[0] - traced_before
+    tracemalloc.stop()
+    rss = rss_bytes() - rss_before
+
+    # empty the first room socket by socket, in no particular order, like a mass disconnect after a deploy
+    room = list(manager.active_connections[0])
+    random.Random(0).shuffle(room)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for connection in room:
+            await manager.disconnect(connection)
+    leave_s = time.perf_counter() - started
+
+    await manager.stop()
+    return {
+        "connections" : connections,
+        "room_size" : room_size,
+        "build_s" : round(build_s, 3),
+        "traced_bytes_per_connection" : round(traced / connections),
+        "rss_bytes_per_connection" : round(rss / connections),
+        "mass_leave_s" : round(leave_s, 4),
+        "mass_leave_us_per_socket" : round(leave_s / len(room) * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=100000)
+    parser.add_argument("--room-size", type=int, default=10000)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args.connections, args.room_size))
+
+    print(f"{result['connections']:,} connections in rooms of {result['room_size']:,} (built in {result['build_s']}s)")
+    print(f"  {result['traced_bytes_per_connection']:,} bytes/connection allocated by Python, {result['rss_bytes_per_connection']:,} bytes/connection RSS")
+    print(f"  emptying one room: {result['mass_leave_s']}s ({result['mass_leave_us_per_socket']}us per socket)")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args" : vars(args), "results" : result}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+CPU per fan-out and bytes on the wire for the websocket wire formats.
+
+Compares, for a few room sizes:
+  per-socket json  -> json.dumps for every recipient (naive baseline, for reference)
+  shared json      -> one Frame, encoded once, same str for every recipient
+  shared msgpack   -> one Frame, encoded once, same bytes for every recipient
+
+Run from the repo root:
+    python -m benchmarks.bench_wire_format [--rounds 200] [--json results.json]
+"""
+import argparse, json, time
+from datetime import datetime
+
+import pytz
+
+from utils.wire import Frame, JSON, MSGPACK, SUPPORTED_FORMATS, encode
+
+ROOM_SIZES = (10, 100, 1000)
+
+
+def typical_events():
+    now = datetime.now(tz=pytz.timezone("Australia/Brisbane")).isoformat()
+    return {
+        "short message" : {"type" : "message", "sender" : "alice", "content" : "on my way, 5 min", "timestamp" : now},
+        "long message" : {"type" : "message", "sender" : "alice", "content" : "lorem ipsum dolor sit amet " * 20, "timestamp" : now},
+        "system" : {"type" : "user_joined", "content" : "alice joined the chat", "timestamp" : now, "sender" : "system"},
+    }
+
+
+def fan_out_per_socket(event, room_size):
+    for _ in range(room_size):
+        json.dumps(event)
+
+
+def fan_out_shared(event, room_size, wire_format):
+    frame = Frame(event)
+    for _ in range(room_size):
+        frame.encoded(wire_format)
+
+
+def cpu_us(fn, rounds):
+    started = time.process_time()
+    for _ in range(rounds):
+        fn()
+    return (time.process_time() - started) / rounds * 1e6
+
+
+def run(rounds):
+    results = []
+    for name, event in typical_events().items():
+        for room_size in ROOM_SIZES:
+            row = {
+                "event" : name,
+                "room_size" : room_size,
+                "cpu_us" : {"per_socket_json" : cpu_us(lambda: fan_out_per_socket(event, room_size), rounds)},
+                "frame_bytes" : {},
+            }
+            for wire_format in SUPPORTED_FORMATS:
+                row["cpu_us"][f"shared_{wire_format}"] = cpu_us(lambda: fan_out_shared(event, room_size, wire_format), rounds)
+                size = len(encode(event, wire_format).encode() if wire_format == JSON else encode(event, wire_format))
+                row["frame_bytes"][wire_format] = size
+                row.setdefault("room_bytes", {})[wire_format] = size * room_size
+            results.append(row)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    if MSGPACK not in SUPPORTED_FORMATS:
+        print("msgpack isn't installed - only measuring JSON")
+
+    results = run(args.rounds)
+
+    for row in results:
+        cpu = ", ".join(f"{k} {v:,.1f}us" for k, v in row["cpu_us"].items())
+        size = ", ".join(f"{k} {v}B" for k, v in row["frame_bytes"].items())
+        print(f"{row['event']:>14} x {row['room_size']:<5} | {cpu} | frame: {size}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"rounds" : args.rounds, "results" : results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""
+Websocket load generator and end-to-end latency benchmark.
+
+Seeds a database with rooms x clients users (every user a member of one room),
+starts the app under uvicorn against it, opens every socket with the websockets
+library, and has each room send at --rate messages/s for --duration seconds.
+Every client timestamps what it sends and what it receives, so the latency
+reported is publish -> delivery on another socket, through the broker, the
+outbound queues and the network stack.
+
+Reports delivery latency percentiles, throughput, and the server's CPU and RSS
+(total and per connection, read from /proc so Linux only). Results can go to
+JSON to compare runs across changes to the ConnectionManager or the write path.
+
+Run from the repo root:
+    python -m benchmarks.ws_load --rooms 10 --clients 50 --rate 20 --duration 10 --json results.json
+
+    --database-url postgresql://...   use Postgres instead of a throwaway SQLite file
+    --endpoint mux                    one multiplexed /ws socket per client instead of /ws/{chat_id}
+    --wire msgpack                    MessagePack frames (needs msgpack installed)
+    --server-env WS_COALESCE_RATE=0   extra environment for the server, repeatable
+"""
+import argparse, asyncio, json, os, random, resource, subprocess, sys, tempfile, time, urllib.request, uuid
+from typing import Dict, List, Optional
+
+import websockets
+
+try:
+    import msgpack
+except ImportError: # optional dependency
+    msgpack = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# -----------------------------------------------------------------------------------------
+# SEEDING ---------------------------------------------------------------------------------
+
+def seed(database_url : str, secret_key : str, rooms : int, clients : int) -> List[List[dict]]:
+    """Create the users, chats and memberships. Returns [room][client] -> {user_id, chat_id, token}."""
+    # the app's modules read these at import time
+    os.environ["DATABASE_URL"] = database_url
+    os.environ["SECRET_KEY"] = secret_key
+    sys.path.insert(0, ROOT)
+
+    from sqlalchemy import insert
+    from database.database import engine
+    from database.models import Base, User, Chat, ChatSummary, Membership, pwd_context
+    from utils.auth import create_access_token
+
+    Base.metadata.create_all(bind=engine)
+
+    run_id = uuid.uuid4().hex[:8] # so a reused database doesn't hit the unique usernames
+    password_hash = pwd_context.hash("load-test") # hashing is slow, every user shares one
+
+    layout = []
+    with engine.begin() as conn:
+        for room in range(rooms):
+            users = conn.execute(
+                insert(User).returning(User.id, sort_by_parameter_order=True),
+                [{
+                    "username" : f"load-{run_id}-{room}-{client}",
+                    "email" : f"load-{run_id}-{room}-{client}@example.com",
+                    "password_hash" : password_hash
+                } for client in range(clients)]
+            ).scalars().all()
+
+            chat_id = conn.execute(
+                insert(Chat).returning(Chat.id),
+                {"name" : f"load-{run_id}-{room}", "creator_id" : users[0], "invite_code" : uuid.uuid4().hex[:8]}
+            ).scalar_one()
+            conn.execute(insert(ChatSummary), {"chat_id" : chat_id, "member_count" : clients})
+            conn.execute(insert(Membership), [{"chat_id" : chat_id, "user_id" : user_id} for user_id in users])
+
+            layout.append([
+                {"user_id" : user_id, "chat_id" : chat_id, "token" : create_access_token({"user_id" : user_id})}
+                for user_id in users
+            ])
+
+    engine.dispose()
+    return layout
+
+
+# -----------------------------------------------------------------------------------------
+# SERVER ----------------------------------------------------------------------------------
+
+def start_server(port : int, workers : int, env : Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT,
+        env={**os.environ, **env},
+        stdout=subprocess.DEVNULL, # the routes print a line per connect/message
+    )
+
+
+def wait_until_up(port : int, timeout : float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            return fetch_metrics(port)
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server didn't come up on port {port}")
+
+
+def fetch_metrics(port : int) -> dict:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+        return json.load(response)
+
+
+def server_pids(pid : int) -> List[int]:
+    """The uvicorn process plus its workers."""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    return pids
+
+
+def process_usage(pids : List[int]) -> Optional[dict]:
+    """CPU seconds and RSS bytes summed over pids, None where /proc isn't available."""
+    ticks = os.sysconf("SC_CLK_TCK")
+    page = resource.getpagesize()
+    cpu = rss = 0
+    try:
+        for pid in pids:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks # utime + stime
+            with open(f"/proc/{pid}/statm") as f:
+                rss += int(f.read().split()[1]) * page
+    except OSError:
+        return None
+    return {"cpu_s" : cpu, "rss_bytes" : rss}
+
+
+# -----------------------------------------------------------------------------------------
+# CLIENTS ---------------------------------------------------------------------------------
+
+class Client:
+    def __init__(self, spec : dict, index : int, args):
+        self.spec = spec
+        self.index = index
+        self.args = args
+        self.websocket = None
+        self.latencies: List[float] = []
+        self.received = 0
+        self.sent = 0
+
+    def url(self) -> str:
+        base = f"ws://127.0.0.1:{self.args.port}"
+        if self.args.endpoint == "mux":
+            return f"{base}/ws?token={self.spec['token']}"
+        return f"{base}/ws/{self.spec['chat_id']}?token={self.spec['token']}"
+
+    def decode(self, data) -> dict:
+        return msgpack.unpackb(data, raw=False) if isinstance(data, bytes) else json.loads(data)
+
+    async def send_json(self, frame : dict):
+        if self.args.wire == "msgpack":
+            await self.websocket.send(msgpack.packb(frame, use_bin_type=True))
+        else:
+            await self.websocket.send(json.dumps(frame))
+
+    async def connect(self):
+        self.websocket = await websockets.connect(self.url(), subprotocols=[self.args.wire], max_size=None, open_timeout=60)
+        if self.args.endpoint == "mux":
+            await self.send_json({"type" : "subscribe", "chat_ids" : [self.spec["chat_id"]]})
+        # the presence snapshot is sent once we're in the room
+        while True:
+            event = self.decode(await self.websocket.recv())
+            if event.get("type") == "presence" and event.get("snapshot"):
+                return
+
+    async def send(self, run_id : str):
+        content = f"{run_id}|{self.index}|{time.perf_counter()}"
+        if self.args.endpoint == "mux":
+            await self.send_json({"type" : "message", "chat_id" : self.spec["chat_id"], "content" : content})
+        else:
+            await self.websocket.send(content) # plain text on the legacy endpoint
+        self.sent += 1
+
+    async def receive(self, run_id : str):
+        try:
+            async for data in self.websocket:
+                now = time.perf_counter()
+                event = self.decode(data)
+                if event.get("type") == "ping":
+                    await self.send_json({"type" : "pong"}) # or the server reaps us on long runs
+                    continue
+                for e in event["events"] if event.get("type") == "batch" else [event]:
+                    if e.get("type") != "message":
+                        continue
+                    marker, sender, sent_at = e["content"].split("|")
+                    if marker == run_id and int(sender) != self.index:
+                        self.latencies.append(now - float(sent_at))
+                        self.received += 1
+        except websockets.ConnectionClosed:
+            pass
+
+
+async def connect_all(clients : List[Client], concurrency : int):
+    gate = asyncio.Semaphore(concurrency)
+
+    async def one(client):
+        async with gate:
+            await client.connect()
+
+    await asyncio.gather(*(one(client) for client in clients))
+
+
+async def drive_room(room : List[Client], rate : float, duration : float, run_id : str):
+    """rate messages/s from random members of the room, on a fixed schedule so slow sends don't lower the rate."""
+    if rate <= 0:
+        return
+    interval = 1 / rate
+    started = time.perf_counter()
+    await asyncio.sleep(random.random() * interval) # spread the rooms out
+    i = 0
+    while time.perf_counter() - started < duration:
+        await random.choice(room).send(run_id)
+        i += 1
+        delay = started + i * interval - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def percentiles(values : List[float]) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 3)
+    return {"p50" : pick(50), "p90" : pick(90), "p99" : pick(99), "p999" : pick(99.9), "max" : round(values[-1] * 1000, 3)}
+
+
+async def run_load(layout : List[List[dict]], args, server_pid : int) -> dict:
+    rooms = [[Client(spec, index, args) for index, spec in enumerate(room)] for room in layout]
+    clients = [client for room in rooms for client in room]
+    pids = server_pids(server_pid)
+
+    idle = process_usage(pids)
+    connect_started = time.perf_counter()
+    await connect_all(clients, args.connect_concurrency)
+    connect_s = time.perf_counter() - connect_started
+    connected = process_usage(pids)
+
+    run_id = uuid.uuid4().hex[:8]
+    receivers = [asyncio.ensure_future(client.receive(run_id)) for client in clients]
+
+    if args.warmup > 0:
+        await asyncio.gather(*(drive_room(room, args.rate, args.warmup, "warmup") for room in rooms))
+        for client in clients:
+            client.sent = 0
+
+    # rates and cpu % are over the send window only - the drain is mostly idle waiting and
+    # would water them down. Its cpu is reported on its own, and still counts in cpu per delivery
+    before = process_usage(pids)
+    started = time.perf_counter()
+    await asyncio.gather(*(drive_room(room, args.rate, args.duration, run_id) for room in rooms))
+    send_s = time.perf_counter() - started
+    sent_usage = process_usage(pids)
+    await asyncio.sleep(args.drain) # let in-flight deliveries land
+    after = process_usage(pids)
+
+    for client in clients:
+        await client.websocket.close()
+    await asyncio.gather(*receivers)
+
+    latencies = [latency for client in clients for latency in client.latencies]
+    sent = sum(client.sent for client in clients)
+    expected = sent * (args.clients - 1) # everyone but the sender
+    result = {
+        "connections" : len(clients),
+        "connect_s" : round(connect_s, 3),
+        "messages_sent" : sent,
+        "deliveries" : len(latencies),
+        "delivery_ratio" : round(len(latencies) / expected, 4) if expected else 0,
+        "send_s" : round(send_s, 3),
+        "sent_per_s" : round(sent / send_s, 1),
+        "deliveries_per_s" : round(len(latencies) / send_s, 1),
+        "latency_ms" : percentiles(latencies),
+    }
+    if idle and connected and before and sent_usage and after:
+        result["server"] = {
+            "cpu_s" : round(sent_usage["cpu_s"] - before["cpu_s"], 3),
+            "cpu_pct" : round((sent_usage["cpu_s"] - before["cpu_s"]) / send_s * 100, 1),
+            "drain_cpu_s" : round(after["cpu_s"] - sent_usage["cpu_s"], 3),
+            "cpu_us_per_delivery" : round((after["cpu_s"] - before["cpu_s"]) / len(latencies) * 1e6, 2) if latencies else None,
+            "rss_idle_bytes" : idle["rss_bytes"],
+            "rss_bytes" : after["rss_bytes"],
+            "rss_per_connection_bytes" : round((connected["rss_bytes"] - idle["rss_bytes"]) / len(clients)),
+        }
+    return result
+
+
+# -----------------------------------------------------------------------------------------
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=20, help="sockets per room")
+    parser.add_argument("--rate", type=float, default=10, help="messages/s sent in each room")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of unmeasured load first")
+    parser.add_argument("--drain", type=float, default=1, help="seconds to wait for deliveries after the last send")
+    parser.add_argument("--endpoint", choices=("legacy", "mux"), default="legacy")
+    parser.add_argument("--wire", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--database-url", help="default: a throwaway SQLite file")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    if args.wire == "msgpack" and msgpack is None:
+        parser.error("--wire msgpack needs the msgpack package")
+
+    raise_fd_limit()
+    tmp = tempfile.TemporaryDirectory()
+    database_url = args.database_url or f"sqlite:///{tmp.name}/ws_load.db"
+    secret_key = uuid.uuid4().hex
+
+    print(f"seeding {args.rooms} rooms x {args.clients} clients")
+    layout = seed(database_url, secret_key, args.rooms, args.clients)
+
+    server_env = dict(item.split("=", 1) for item in args.server_env)
+    server = start_server(args.port, args.workers, {"DATABASE_URL" : database_url, "SECRET_KEY" : secret_key, **server_env})
+    try:
+        wait_until_up(args.port)
+        result = asyncio.run(run_load(layout, args, server.pid))
+        result["metrics"] = fetch_metrics(args.port)
+    finally:
+        server.terminate()
+        server.wait()
+        tmp.cleanup()
+
+    latency = ", ".join(f"{k} {v}ms" for k, v in result["latency_ms"].items())
+    print(f"{result['connections']} sockets connected in {result['connect_s']}s")
+    print(f"sent {result['sent_per_s']}/s, delivered {result['deliveries_per_s']}/s ({result['delivery_ratio']:.2%} of expected)")
+    print(f"latency: {latency}")
+    if "server" in result:
+        server_stats = result["server"]
+        print(f"server: {server_stats['cpu_pct']}% cpu (+{server_stats['drain_cpu_s']}s draining), {server_stats['cpu_us_per_delivery']}us/delivery, "
+              f"{server_stats['rss_bytes'] / 2**20:.1f}MB rss, ~{server_stats['rss_per_connection_bytes'] / 1024:.1f}KB/connection")
+
+    if args.json:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        with open(args.json, "w") as f:
+            json.dump({"commit" : commit, "args" : vars(args), "results" : result}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.engine.result import FrozenResult
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+import anyio
 from dotenv import load_dotenv
 import os
 from fastapi import Depends
@@ -8,18 +14,133 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
+# DB_ASYNC=false puts routes back on the blocking driver (run in the thread pool) for A/B testing
+DB_ASYNC = os.getenv("DB_ASYNC", "true").lower() in ("1", "true", "yes")
+
+# per engine. Websockets only check a connection out for the duration of a query
+# (see session_scope), so these cap concurrent queries, not concurrent sockets
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
+def pool_options(database_url : str) -> dict:
+    # in-memory SQLite uses a single shared connection, there's no pool to size
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}
+    return {"pool_size" : DB_POOL_SIZE, "max_overflow" : DB_MAX_OVERFLOW}
+
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-    
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
-        
+
+
+# -----------------------------------------------------------------------------------------
+# ASYNC SESSIONS --------------------------------------------------------------------------
+
+ASYNC_DRIVERS = {
+    "postgresql" : "postgresql+asyncpg",
+    "sqlite" : "sqlite+aiosqlite",
+}
+
+def async_database_url(database_url : str) -> str:
+    """postgresql://... or postgresql+psycopg2://... -> postgresql+asyncpg://..."""
+    url = make_url(database_url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername)).render_as_string(hide_password=False)
+
+if DB_ASYNC:
+    async_engine = create_async_engine(async_database_url(DATABASE_URL), **pool_options(DATABASE_URL))
+    # expire_on_commit=False - lazy reloads after a commit aren't possible on an AsyncSession
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+else:
+    async_engine = None
+    AsyncSessionLocal = None
+
+ThreadedSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+
+class ThreadedSession:
+    """
+    The sync fallback for DB_ASYNC=false. Wraps a normal Session behind the same awaitable
+    methods as AsyncSession, running each call in the thread pool, so routes only need
+    to be written once.
+    """
+    def __init__(self, session):
+        self.sync_session = session
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    def _execute_buffered(self, *args, **kwargs):
+        # fetch every row (and run selectinload's extra queries) here in the worker thread -
+        # a live ORM result would do that wherever it's iterated, i.e. on the event loop
+        result = self.sync_session.execute(*args, **kwargs)
+        # (inserts/updates without RETURNING have nothing to buffer, and can't be frozen anyway)
+        return result.freeze() if getattr(result._metadata, "returns_rows", True) else result
+
+    async def execute(self, *args, **kwargs):
+        result = await run_in_threadpool(self._execute_buffered, *args, **kwargs)
+        return result() if isinstance(result, FrozenResult) else result
+
+    async def scalar(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return (await self.execute(*args, **kwargs)).scalars()
+
+    async def get(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, *args, **kwargs)
+
+    async def flush(self, *args, **kwargs):
+        await run_in_threadpool(self.sync_session.flush, *args, **kwargs)
+
+    async def refresh(self, *args, **kwargs):
+        await run_in_threadpool(self.sync_session.refresh, *args, **kwargs)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+
+@asynccontextmanager
+async def session_scope():
+    """An AsyncSession (or ThreadedSession when DB_ASYNC is off) for one unit of work."""
+    if DB_ASYNC:
+        async with AsyncSessionLocal() as db:
+            yield db
+    else:
+        db = ThreadedSession(ThreadedSessionLocal())
+        try:
+            yield db
+        finally:
+            # shielded - if the caller was cancelled mid-query, an unclosed session would keep
+            # its connection (and any write lock) checked out for good
+            with anyio.CancelScope(shield=True):
+                await db.close()
+
+async def get_async_db():
+    async with session_scope() as db:
+        yield db
+
+
 try:
     with engine.connect() as conn:
         print("Connected to Supabase successfully!")
 except Exception as e:
-    print("Connection failed:", e)
\ No newline at end of file
+    print("Connection failed:", e)
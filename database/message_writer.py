@@ -0,0 +1,227 @@
+"""
+Write-behind persistence for chat messages.
+
+The websocket receive loop hands rows to message_writer.submit() and moves on.
+A background task collects them into batches (MESSAGE_BATCH_SIZE rows or
+MESSAGE_FLUSH_INTERVAL_MS, whichever comes first) and writes each batch as one
+batched INSERT on its own session (asyncpg, or the thread pool when DB_ASYNC is off),
+so the receive loop never waits on the database.
+
+A row the database turns down (a chat deleted mid-conversation, say) only fails
+itself: the batch it was in is split until the bad row is on its own.
+
+The queue is bounded by MESSAGE_WRITER_MAX_PENDING - when it's full submit()
+waits, which slows down only the sockets that are sending.
+
+Rows can carry the sender's client_msg_id. A row whose (creator_id, client_msg_id)
+is already stored is skipped rather than inserted twice, and its done callback gets
+the stored message's id and seq instead - that's what the sender is acked with.
+"""
+import asyncio, os, time
+from typing import Callable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+
+from database.database import session_scope
+from database.models import Message
+from database.queries import record_messages, stored_client_messages
+from utils.debug_utils import logger
+
+load_dotenv()
+
+MESSAGE_BATCH_SIZE = int(os.getenv("MESSAGE_BATCH_SIZE", "200"))
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "50"))
+MESSAGE_WRITER_MAX_PENDING = int(os.getenv("MESSAGE_WRITER_MAX_PENDING", "10000"))
+MESSAGE_FLUSH_RETRIES = 3
+
+_STOP = object() # queued by stop() so everything submitted before it still gets written
+
+def _transient(e : Exception) -> bool:
+    """Lost/refused connections and the like, worth trying the same rows again."""
+    if isinstance(e, (OperationalError, InterfaceError, OSError, asyncio.TimeoutError)):
+        return True
+    return isinstance(e, DBAPIError) and e.connection_invalidated
+
+# called once the row is stored with (message id, seq), or with (None, None) if it couldn't be
+Done = Callable[[Optional[int], Optional[int]], None]
+
+
+class MessageWriter:
+    def __init__(
+        self,
+        batch_size : int = MESSAGE_BATCH_SIZE,
+        flush_interval_ms : int = MESSAGE_FLUSH_INTERVAL_MS,
+        max_pending : int = MESSAGE_WRITER_MAX_PENDING
+        ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max_pending
+
+        self.queue: Optional[asyncio.Queue] = None
+        self.batch_ready: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+        # metrics
+        self.messages_written = 0
+        self.messages_failed = 0
+        self.messages_deduplicated = 0 # retries that were already stored
+        self.batches = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.batch_ready = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Flush everything that's been submitted, then stop the background task."""
+        if self.task is None:
+            return
+        await self.queue.put(_STOP)
+        self.batch_ready.set()
+        await self.task
+        self.task = None
+
+    async def submit(self, row : dict, done : Optional[Done] = None):
+        """Queue a Message row (as a dict of column values, id included) to be written."""
+        await self.queue.put((row, done))
+        if self.queue.qsize() >= self.batch_size:
+            self.batch_ready.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            first = await self.queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+
+            # keep collecting until the batch is full or the window closes
+            while True:
+                while len(batch) < self.batch_size and not self.queue.empty():
+                    item = self.queue.get_nowait()
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+
+                remaining = deadline - loop.time()
+                if stopping or len(batch) >= self.batch_size or remaining <= 0:
+                    break
+
+                self.batch_ready.clear()
+                try:
+                    await asyncio.wait_for(self.batch_ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+            await self._flush(batch)
+
+    async def _flush(self, batch : List[Tuple[dict, Optional[Done]]]):
+        started = time.perf_counter()
+        stored = await self._write([row for row, _ in batch])
+        self._done(batch, stored)
+
+        written = sum(1 for message_id, _ in stored if message_id is not None)
+        self.messages_failed += len(batch) - written
+        if not written:
+            return
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.messages_written += written
+        self.batches += 1
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+
+    async def _write(self, rows : List[dict]) -> List[Tuple[Optional[int], Optional[int]]]:
+        """
+        (id, seq) per row, (None, None) for rows that couldn't be stored. Connection
+        trouble is retried with the whole batch; anything else means the database
+        turned a row down, so the batch is split in half until only that row fails.
+        """
+        for attempt in range(MESSAGE_FLUSH_RETRIES):
+            try:
+                return await self._insert(rows)
+            except Exception as e:
+                if not _transient(e):
+                    error = e
+                    break
+                logger.error(f"message flush failed ({len(rows)} rows, attempt {attempt + 1}) -> {e}")
+                await asyncio.sleep(0.1 * 2 ** attempt)
+        else:
+            return [(None, None)] * len(rows) # the database is down, nothing to split
+
+        if len(rows) == 1:
+            logger.error(f"message rejected (chat {rows[0]['chat_id']}, id {rows[0]['id']}) -> {error}")
+            return [(None, None)]
+        # a unique violation from a retry stored by another worker in the meantime lands
+        # here too - the halves' client_msg_id checks find it
+        half = len(rows) // 2
+        return await self._write(rows[:half]) + await self._write(rows[half:])
+
+    def _done(self, batch : List[Tuple[dict, Optional[Done]]], stored : List[Tuple[Optional[int], Optional[int]]]):
+        for (_, done), (message_id, seq) in zip(batch, stored):
+            if done is not None:
+                try:
+                    done(message_id, seq)
+                except Exception as e:
+                    logger.error(f"message done callback failed -> {e}")
+
+    async def _insert(self, batch : List[dict]) -> List[Tuple[int, Optional[int]]]:
+        """Write the batch, returns (id, seq) each row ended up stored as."""
+        async with session_scope() as db:
+            # only rows with a client_msg_id can be retries - one lookup for the whole batch
+            keys = [(row["creator_id"], row["client_msg_id"]) for row in batch if row.get("client_msg_id") is not None]
+            stored = await stored_client_messages(db, keys)
+
+            fresh = [] # rows to insert
+            outcome = [] # per row: the (id, seq) it's stored as
+            for row in batch:
+                key = (row["creator_id"], row["client_msg_id"]) if row.get("client_msg_id") is not None else None
+                if key in stored:
+                    outcome.append(stored[key]) # a retry, maybe of a row earlier in this batch
+                    continue
+                if key is not None:
+                    stored[key] = (row["id"], row.get("seq"))
+                outcome.append((row["id"], row.get("seq")))
+                fresh.append(row)
+
+            if fresh:
+                # ids are already set (snowflakes) so there's nothing to read back, and the
+                # driver batches the executemany (multi-row VALUES on psycopg2, pipelined on asyncpg)
+                await db.execute(insert(Message), fresh)
+                await record_messages(db, fresh)
+            await db.commit() # messages and their chat summaries land together
+
+        self.messages_deduplicated += len(batch) - len(fresh)
+        return outcome
+
+    def stats(self) -> dict:
+        return {
+            "pending" : self.queue.qsize() if self.queue is not None else 0,
+            "messages_written" : self.messages_written,
+            "messages_failed" : self.messages_failed,
+            "messages_deduplicated" : self.messages_deduplicated,
+            "batches" : self.batches,
+            "last_batch_size" : self.last_batch_size,
+            "max_batch_size" : self.max_batch_size,
+            "avg_batch_size" : self.messages_written / self.batches if self.batches else 0,
+            "last_flush_ms" : round(self.last_flush_ms, 3),
+            "max_flush_ms" : round(self.max_flush_ms, 3),
+            "avg_flush_ms" : round(self.total_flush_ms / self.batches, 3) if self.batches else 0,
+        }
+
+
+message_writer = MessageWriter()
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Text, DateTime, func, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, ForeignKey, Text, DateTime, func, UniqueConstraint, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -8,9 +8,7 @@ from utils.join_utils import generate_invite_code
 import pytz
 from datetime import datetime
 
-from passlib.context import CryptContext
-# Set up a password context
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+from utils.passwords import pwd_context # routes hash through utils.passwords.password_hasher instead
 
 Base = declarative_base() # base class for all models
 
@@ -35,7 +33,7 @@ class User(Base): # make sure to handle shit when user is deleted
             "email" : self.email,
         }
     
-    # password methods
+    # password methods - these block for the whole argon2 run, routes use utils.passwords.password_hasher
     def set_password(self, password: str):
         self.password_hash = pwd_context.hash(password)
 
@@ -55,6 +53,7 @@ class Chat(Base):
     creator = relationship("User", back_populates="owned_chats")
     memberships = relationship("Membership", back_populates="chat", cascade="all, delete-orphan")
     messages = relationship("Message", back_populates="chat", cascade="all, delete-orphan")
+    summary = relationship("ChatSummary", back_populates="chat", uselist=False, cascade="all, delete-orphan")
 
     def to_dict(self):
         return {
@@ -71,6 +70,7 @@ class Membership(Base):
     user_id = Column(Integer, ForeignKey("users.id"), index=True)
     joined_at = Column(DateTime(timezone=True), server_default=func.now())
     pinned=Column(Boolean, index=True, default=False, nullable=True)
+    last_read_seq = Column(BigInteger, nullable=False, default=0, server_default="0") # newest seq this member has read (see database/read_cursors.py)
 
     # relationships
     user = relationship("User", back_populates="memberships")
@@ -85,6 +85,36 @@ class Membership(Base):
             "id" : self.id,
             "chat_id" : self.chat_id,
             "user_id" : self.user_id,
+            "last_read_seq" : self.last_read_seq,
+        }
+
+class ChatSummary(Base):
+    """
+    One narrow row per chat so chat lists don't have to touch messages.
+    Kept up to date in the same transaction as the writes it summarises
+    (message batches in database/message_writer.py, membership routes).
+    """
+    __tablename__ = "chat_summaries"
+
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), primary_key=True)
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    member_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_id = Column(BigInteger, nullable=True)
+    last_message_at = Column(DateTime(timezone=True), nullable=True)
+    last_activity_at = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
+    last_seq = Column(BigInteger, nullable=False, default=0, server_default="0") # newest broadcast (or reserved) seq, see utils/broker.py
+
+    chat = relationship("Chat", back_populates="summary")
+
+    def to_dict(self):
+        return {
+            "chat_id" : self.chat_id,
+            "message_count" : self.message_count,
+            "member_count" : self.member_count,
+            "last_message_id" : self.last_message_id,
+            "last_message_at" : self.last_message_at,
+            "last_activity_at" : self.last_activity_at,
+            "last_seq" : self.last_seq,
         }
 
 def brisbane_now():
@@ -93,21 +123,39 @@ def brisbane_now():
 class Message(Base):
     __tablename__ = "messages"
 
-    id = Column(Integer, primary_key=True, index=True)
-    chat_id = Column(Integer, ForeignKey("chats.id"), index=True, nullable=False)
+    # snowflake (utils/snowflake.py), made when the message is sent - INTEGER on SQLite so it stays the rowid
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=False)
+    chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
     creator_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False) # foreign key ensures that this value matches something in users
     content = Column(Text, nullable=False)
     time_sent = Column(DateTime(timezone=True), nullable=False)
+    seq = Column(BigInteger, nullable=True) # per-chat broadcast sequence number, null if the broadcast failed
+    client_msg_id = Column(String(64), nullable=True) # the sender's id for it, so retries aren't stored twice
 
     # relationships
     creator = relationship("User", back_populates="sent_messages")
     chat = relationship("Chat", back_populates="messages")
 
+    __table_args__ = (
+        # history pages and latest-N: ids are time-ordered, so "messages in chat X before/after id N"
+        # is the keyset. Also covers lookups by chat_id alone
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        # websocket resume catch-up: "messages in chat X after seq N"
+        Index("ix_messages_chat_id_seq", "chat_id", "seq"),
+        # backstop for retried sends the message writer didn't catch in memory
+        Index(
+            "ux_messages_creator_id_client_msg_id", "creator_id", "client_msg_id", unique=True,
+            postgresql_where=text("client_msg_id IS NOT NULL"), sqlite_where=text("client_msg_id IS NOT NULL")
+        ),
+    )
+
     def to_dict(self):
         return {
             "id" : self.id,
             "chat_id" : self.chat_id,
             "creator_id" : self.creator_id,
             "content" : self.content,
-            "time_sent" : self.time_sent
+            "time_sent" : self.time_sent,
+            "seq" : self.seq,
+            "client_msg_id" : self.client_msg_id
         }
\ No newline at end of file
@@ -0,0 +1,276 @@
+"""
+Shared queries for the routes and the message writer.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pytz
+
+from sqlalchemy import select, update, func, true, bindparam, case, or_, and_, null, tuple_
+
+from database.database import engine, session_scope
+from database.models import Chat, ChatSummary, Membership, Message, User
+
+import utils.pydantic_models as models
+
+# how many messages a ChatOut carries in initial_messages
+INITIAL_MESSAGES = 10
+# unread counts stop here, anything past it is shown as "99+"
+UNREAD_COUNT_CAP = 99
+
+
+BRISBANE = pytz.timezone("Australia/Brisbane")
+
+
+def format_timestamp(sent : datetime) -> str:
+    """
+    Every message timestamp clients see, live or loaded: ISO 8601 in Brisbane time.
+    Naive values (SQLite drops the offset) were written in Brisbane time.
+    """
+    if sent.tzinfo is None:
+        sent = BRISBANE.localize(sent)
+    return sent.astimezone(BRISBANE).isoformat()
+
+
+def message_out(mess : Message, username : str) -> models.MessageOut:
+    return models.MessageOut(
+        id = mess.id,
+        sender = username,
+        contents = mess.content,
+        timestamp = format_timestamp(mess.time_sent),
+        seq = mess.seq
+    )
+
+
+async def latest_messages_by_chat(db, chat_ids : Sequence[int], n : int = INITIAL_MESSAGES) -> Dict[int, List[models.MessageOut]]:
+    """
+    The newest n messages of every chat in chat_ids (oldest -> newest) in a single query.
+
+    Postgres uses a LATERAL join, so each chat is a short backwards range scan on
+    ix_messages_chat_id_id and the cost doesn't grow with how many messages a chat has.
+    Ids are snowflakes, so newest id is newest message. Other databases (SQLite in dev)
+    fall back to row_number() over each chat.
+    """
+    latest: Dict[int, List[models.MessageOut]] = {chat_id : [] for chat_id in chat_ids}
+    if not chat_ids:
+        return latest
+
+    if engine.dialect.name == "postgresql":
+        chat_rows = select(Chat.id.label("chat_id")).where(Chat.id.in_(chat_ids)).subquery()
+        top_n = (
+            select(Message.id)
+            .where(Message.chat_id == chat_rows.c.chat_id)
+            .order_by(Message.id.desc())
+            .limit(n)
+            .lateral()
+        )
+        picked = select(top_n.c.id).select_from(chat_rows).join(top_n, true()).subquery()
+    else:
+        ranked = (
+            select(
+                Message.id,
+                func.row_number().over(
+                    partition_by=Message.chat_id,
+                    order_by=Message.id.desc()
+                ).label("rank")
+            )
+            .where(Message.chat_id.in_(chat_ids))
+            .subquery()
+        )
+        picked = select(ranked.c.id).where(ranked.c.rank <= n).subquery()
+
+    rows = await db.execute(
+        select(Message, User.username)
+        .join(picked, picked.c.id == Message.id)
+        .join(User, User.id == Message.creator_id)
+        .order_by(Message.chat_id, Message.id)
+    )
+    for mess, username in rows:
+        latest[mess.chat_id].append(message_out(mess, username))
+
+    return latest
+
+
+async def messages_after_seq(db, chat_id : int, after_seq : int, before_seq : Optional[int] = None, limit : int = 500) -> List[Tuple[Message, str]]:
+    """(message, username) for messages in chat_id with after_seq < seq < before_seq, oldest first."""
+    query = (
+        select(Message, User.username)
+        .join(User, User.id == Message.creator_id)
+        .where(Message.chat_id == chat_id, Message.seq > after_seq)
+        .order_by(Message.seq)
+        .limit(limit)
+    )
+    if before_seq is not None:
+        query = query.where(Message.seq < before_seq)
+    return list((await db.execute(query)).tuples())
+
+
+async def newest_message_seq(db, chat_id : int) -> int:
+    """Seq of the newest stored message in chat_id, 0 if there isn't one."""
+    return await db.scalar(select(func.max(Message.seq)).where(Message.chat_id == chat_id)) or 0
+
+
+async def stored_client_messages(db, keys : Sequence[Tuple[int, str]]) -> Dict[Tuple[int, str], Tuple[int, Optional[int]]]:
+    """(creator_id, client_msg_id) -> (id, seq) for the keys that are already stored."""
+    if not keys:
+        return {}
+    rows = await db.execute(
+        select(Message.creator_id, Message.client_msg_id, Message.id, Message.seq)
+        .where(tuple_(Message.creator_id, Message.client_msg_id).in_(keys))
+    )
+    return {(creator_id, client_msg_id) : (message_id, seq) for creator_id, client_msg_id, message_id, seq in rows}
+
+
+async def reserve_seqs(chat_id : int, n : int) -> Optional[int]:
+    """
+    Move a chat's last_seq on by n and return the new value, so seqs up to it are
+    taken even if this process dies before using them. None if the chat has no
+    summary row. Opens its own session.
+    """
+    async with session_scope() as db:
+        await db.execute(
+            update(ChatSummary).where(ChatSummary.chat_id == chat_id).values(last_seq = ChatSummary.last_seq + n)
+        )
+        last_seq = await db.scalar(select(ChatSummary.last_seq).where(ChatSummary.chat_id == chat_id))
+        await db.commit()
+    return last_seq
+
+
+async def member_chat_ids(db, user_id : int, chat_ids : Sequence[int]) -> List[int]:
+    """The subset of chat_ids user_id is a member of."""
+    if not chat_ids:
+        return []
+    return list((await db.execute(
+        select(Membership.chat_id).where(Membership.user_id == user_id, Membership.chat_id.in_(chat_ids))
+    )).scalars())
+
+
+# -----------------------------------------------------------------------------------------
+# CHAT SUMMARIES --------------------------------------------------------------------------
+
+async def adjust_member_count(db, chat_id : int, delta : int):
+    """Call inside the same transaction as the membership insert/delete."""
+    await db.execute(
+        update(ChatSummary)
+        .where(ChatSummary.chat_id == chat_id)
+        .values(
+            member_count = ChatSummary.member_count + delta,
+            last_activity_at = func.now()
+        )
+    )
+
+
+summaries = ChatSummary.__table__
+
+# executemany-able: one parameter set per chat touched by a message batch.
+# last_* only move forward, so batches from different workers can commit in any order
+_record_messages = (
+    update(summaries)
+    .where(summaries.c.chat_id == bindparam("b_chat_id"))
+    .values(
+        message_count = summaries.c.message_count + bindparam("b_count"),
+        last_message_id = case(
+            (or_(summaries.c.last_message_at.is_(None), summaries.c.last_message_at <= bindparam("b_last_at")), bindparam("b_last_id")),
+            else_ = summaries.c.last_message_id
+        ),
+        last_message_at = case(
+            (or_(summaries.c.last_message_at.is_(None), summaries.c.last_message_at <= bindparam("b_last_at")), bindparam("b_last_at")),
+            else_ = summaries.c.last_message_at
+        ),
+        last_activity_at = case(
+            (summaries.c.last_activity_at < bindparam("b_last_at"), bindparam("b_last_at")),
+            else_ = summaries.c.last_activity_at
+        ),
+        last_seq = case(
+            (summaries.c.last_seq < bindparam("b_last_seq"), bindparam("b_last_seq")),
+            else_ = summaries.c.last_seq
+        )
+    )
+)
+
+async def record_messages(db, messages : List[dict]):
+    """
+    Fold a batch of just-inserted messages (dicts with id, chat_id, time_sent, seq) into
+    chat_summaries. Call inside the same transaction as the insert.
+    """
+    per_chat: Dict[int, dict] = {}
+    for mess in messages:
+        params = per_chat.setdefault(mess["chat_id"], {
+            "b_chat_id" : mess["chat_id"], "b_count" : 0, "b_last_id" : None, "b_last_at" : None, "b_last_seq" : None
+        })
+        params["b_count"] += 1
+        if mess.get("seq") is not None:
+            params["b_last_seq"] = max(params["b_last_seq"] or 0, mess["seq"])
+        if params["b_last_at"] is None or mess["time_sent"] >= params["b_last_at"]:
+            params["b_last_id"] = mess["id"]
+            params["b_last_at"] = mess["time_sent"]
+
+    if per_chat:
+        # same lock order in every transaction -> concurrent batches can't deadlock
+        await db.execute(_record_messages, [per_chat[chat_id] for chat_id in sorted(per_chat)])
+
+
+# -----------------------------------------------------------------------------------------
+# READ CURSORS ----------------------------------------------------------------------------
+
+memberships = Membership.__table__
+
+# executemany-able, one parameter set per (chat, user). Only moves forward, so a flush
+# can't undo a newer one that committed first (or one from another worker)
+_advance_read_cursors = (
+    update(memberships)
+    .where(memberships.c.chat_id == bindparam("b_chat_id"), memberships.c.user_id == bindparam("b_user_id"))
+    .values(
+        last_read_seq = case(
+            (memberships.c.last_read_seq < bindparam("b_seq"), bindparam("b_seq")),
+            else_ = memberships.c.last_read_seq
+        )
+    )
+)
+
+async def advance_read_cursors(db, cursors : Dict[Tuple[int, int], int]):
+    """Move (chat_id, user_id) -> seq read cursors forward in one statement. Caller commits."""
+    if cursors:
+        # sorted like record_messages -> concurrent flushes lock rows in the same order
+        await db.execute(_advance_read_cursors, [
+            {"b_chat_id" : chat_id, "b_user_id" : user_id, "b_seq" : cursors[chat_id, user_id]}
+            for chat_id, user_id in sorted(cursors)
+        ])
+
+
+async def unread_counts(
+    db,
+    user_id : int,
+    cursors : Optional[Dict[int, int]] = None,
+    skip : Sequence[int] = (),
+    cap : int = UNREAD_COUNT_CAP
+    ) -> List[Tuple[int, int, Optional[int]]]:
+    """
+    (chat_id, read cursor, unread) for every chat user_id is a member of, in one query.
+
+    unread counts other people's messages after the cursor, and stops at cap + 1 - each
+    chat is a short range scan on ix_messages_chat_id_seq however far behind the user is.
+    cursors are newer cursors than the table has (ones still waiting in read_cursors),
+    and chats in skip get None instead of a count (they're counted somewhere else).
+    """
+    cursor = Membership.last_read_seq
+    if cursors:
+        cursor = case(
+            *[(and_(Membership.chat_id == chat_id, Membership.last_read_seq < seq), seq) for chat_id, seq in cursors.items()],
+            else_ = Membership.last_read_seq
+        )
+
+    unread = (
+        select(Message.id)
+        .where(Message.chat_id == Membership.chat_id, Message.seq > cursor, Message.creator_id != user_id)
+        .limit(cap + 1)
+        .correlate(Membership)
+        .subquery()
+    )
+    count = select(func.count()).select_from(unread).scalar_subquery()
+    if skip:
+        count = case((Membership.chat_id.in_(skip), null()), else_ = count)
+
+    return list((await db.execute(
+        select(Membership.chat_id, cursor, count).where(Membership.user_id == user_id)
+    )).tuples())
@@ -0,0 +1,109 @@
+"""
+Write-behind persistence for read cursors (chat_memberships.last_read_seq).
+
+Clients send a read position every time they scroll, so read_cursors.submit() only
+keeps the newest seq per (chat_id, user_id) in memory. Every READ_CURSOR_FLUSH_MS
+whatever changed is written as one bulk UPDATE - a user reading through a chat costs
+one row update per flush, not one per message.
+
+Cursors only move forward, in memory and in the UPDATE. A failed flush puts its
+cursors back to go out with the next one.
+"""
+import asyncio, os, time
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from database.database import session_scope
+from database.queries import advance_read_cursors
+from utils.debug_utils import logger
+
+load_dotenv()
+
+READ_CURSOR_FLUSH_MS = int(os.getenv("READ_CURSOR_FLUSH_MS", "2000"))
+
+
+class ReadCursorWriter:
+    def __init__(self, flush_interval_ms : int = READ_CURSOR_FLUSH_MS):
+        self.flush_interval = flush_interval_ms / 1000
+        self.pending: Dict[Tuple[int, int], int] = {} # (chat_id, user_id) -> newest seq read
+        self.task: Optional[asyncio.Task] = None
+
+        # metrics
+        self.submitted = 0
+        self.cursors_written = 0
+        self.cursors_failed = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    async def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """Stop the timer and write whatever is still pending."""
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        await self.flush()
+
+    def submit(self, chat_id : int, user_id : int, seq : int) -> bool:
+        """Record that user_id has read chat_id up to seq. False if that's not news."""
+        key = (chat_id, user_id)
+        if seq <= self.pending.get(key, -1):
+            return False
+        self.pending[key] = seq
+        self.submitted += 1
+        return True
+
+    def pending_for(self, user_id : int) -> Dict[int, int]:
+        """chat_id -> seq for user_id's cursors that haven't been written yet."""
+        return {chat_id : seq for (chat_id, pending_user), seq in self.pending.items() if pending_user == user_id}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        started = time.perf_counter()
+
+        try:
+            async with session_scope() as db:
+                await advance_read_cursors(db, batch)
+                await db.commit()
+        except Exception as e:
+            logger.error(f"read cursor flush failed ({len(batch)} cursors) -> {e}")
+            self.cursors_failed += len(batch)
+            for key, seq in batch.items():
+                if seq > self.pending.get(key, -1): # anything newer that came in meanwhile wins
+                    self.pending[key] = seq
+            return
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.cursors_written += len(batch)
+        self.flushes += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+
+    def stats(self) -> dict:
+        return {
+            "pending" : len(self.pending),
+            "submitted" : self.submitted,
+            "cursors_written" : self.cursors_written,
+            "cursors_failed" : self.cursors_failed,
+            "flushes" : self.flushes,
+            "last_flush_ms" : round(self.last_flush_ms, 3),
+            "max_flush_ms" : round(self.max_flush_ms, 3),
+        }
+
+
+read_cursors = ReadCursorWriter()
@@ -1,4 +1,5 @@
 import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -8,9 +9,29 @@ from dotenv import load_dotenv
 from routes.users import users as users_router
 from routes.sessions import sessions as sessions_router
 from routes.chats import chats as chats_router
-from routes.websocket import router as websocket_router
-
-app = FastAPI()
+from routes.websocket import router as websocket_router, manager
+from routes.metrics import metrics as metrics_router
+from database.message_writer import message_writer
+from database.read_cursors import read_cursors
+from utils.passwords import password_hasher
+from utils.snowflake import worker_id_lease
+
+@asynccontextmanager
+async def lifespan(app : FastAPI):
+    # broker subscriptions etc. need the running event loop
+    await worker_id_lease.start() # before any message id is handed out
+    await password_hasher.start() # spawns the argon2 worker processes
+    await message_writer.start()
+    await read_cursors.start()
+    await manager.start()
+    yield
+    await manager.stop()
+    await read_cursors.stop()
+    await message_writer.stop() # flushes anything still queued
+    await password_hasher.stop()
+    await worker_id_lease.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 load_dotenv()
 
@@ -35,6 +56,7 @@ app.include_router(users_router)
 app.include_router(sessions_router)
 app.include_router(chats_router)
 app.include_router(websocket_router)
+app.include_router(metrics_router)
 
 @app.get("/")
 def root():
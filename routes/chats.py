@@ -1,8 +1,15 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-
-from sqlalchemy.orm import Session
-from database.database import get_db
-from database.models import User, Chat, Message, Membership
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import get_async_db
+from database.queries import message_out
+from utils.message_cache import recent_messages
+from utils.admission_cache import admission_cache
+from routes.websocket import manager
+from database.models import User, Chat, ChatSummary, Message, Membership
 
 from utils.auth import get_current_user_id
 
@@ -16,7 +23,7 @@ chats = APIRouter()
 from utils.debug_utils import logger
 
 @chats.post("/chats", status_code=status.HTTP_201_CREATED, response_model=model.ChatOut)
-def new_chat(chat_info : model.ChatCreate, db:Session=Depends(get_db), user_id : int = Depends(get_current_user_id)):
+async def new_chat(chat_info : model.ChatCreate, db:AsyncSession=Depends(get_async_db), user_id : int = Depends(get_current_user_id)):
     try:
         # make the chat
         new_chat = Chat(
@@ -24,7 +31,7 @@ def new_chat(chat_info : model.ChatCreate, db:Session=Depends(get_db), user_id :
             creator_id = user_id
         )
         db.add(new_chat)
-        db.flush() # PUSHES changes from the db e.g. to get an id
+        await db.flush() # PUSHES changes from the db e.g. to get an id
     
         # make the first membership
         creator_membership = Membership (
@@ -33,11 +40,12 @@ def new_chat(chat_info : model.ChatCreate, db:Session=Depends(get_db), user_id :
         )
             
         db.add(creator_membership)
-        db.flush()
+        db.add(ChatSummary(chat_id = new_chat.id, member_count = 1))
+        await db.flush()
         
-        db.commit()
-        db.refresh(new_chat) # PULLS changes from the db e.g. server defaults
-        db.refresh(creator_membership)
+        await db.commit()
+        await db.refresh(new_chat, attribute_names=["memberships"]) # PULLS changes from the db e.g. server defaults
+        await db.refresh(creator_membership, attribute_names=["user"])
 
 
         return {
@@ -51,6 +59,7 @@ def new_chat(chat_info : model.ChatCreate, db:Session=Depends(get_db), user_id :
                     creator = True if mem.user_id == creator_membership.user_id else False
                 ) for mem in new_chat.memberships
             ],
+            "initial_messages" : [], # brand new chat
             "id" : new_chat.id
         }
         
@@ -62,29 +71,75 @@ def new_chat(chat_info : model.ChatCreate, db:Session=Depends(get_db), user_id :
             status_code = status.HTTP_500_INTERNAL_SERVER_ERROR, 
             detail=f"Error making chat: {e} \n Line : {problem_line}")
 
-@chats.get("/chats/{chat_id}/messages")
-def get_rest_of_chat_messages(chat_id : int, user_id : int = Depends(get_current_user_id), db : Session = Depends(get_db)):
-    try:
-        # get the chat
-        subject_chat = db.query(Chat).filter_by(id = chat_id).first()
-        
-        if not subject_chat or subject_chat is None:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Requested chat was not found")
-
-        # most recent 10 are already given to the client
-        print("SCM -> ", subject_chat.messages)
-        all_chat_messages = sorted(subject_chat.messages, key=lambda x: x.time_sent)[:-10]
-        
-        
-        return all_chat_messages
-    except Exception as e:
-        logging.error(f"ERROR ON get all messages : {e}")
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+@chats.get("/chats/{chat_id}/messages", response_model=model.MessagePage)
+async def get_rest_of_chat_messages(
+    chat_id : int, 
+    before_id : Optional[int] = None, # older than this message (scrolling back)
+    after_id : Optional[int] = None, # newer than this message (catching up)
+    limit : int = Query(50, ge=1, le=200),
+    user_id : int = Depends(get_current_user_id), 
+    db : AsyncSession = Depends(get_async_db)
+    ):
+    # keyset pagination on id - ids are snowflakes (utils/snowflake.py), so id order is send order
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Use either before_id or after_id, not both")
+
+    chat_exists = (await db.execute(select(Chat.id).filter_by(id = chat_id))).scalar()
+    if chat_exists is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Requested chat was not found")
+
+    query = (
+        select(Message, User.username)
+        .join(User, User.id == Message.creator_id)
+        .where(Message.chat_id == chat_id)
+    )
+    if after_id is not None:
+        query = query.where(Message.id > after_id)
+    elif before_id is not None:
+        query = query.where(Message.id < before_id)
+
+    # fetch one extra row to find out whether there's another page
+    if after_id is not None:
+        query = query.order_by(Message.id.asc())
+    else:
+        query = query.order_by(Message.id.desc())
+    rows = (await db.execute(query.limit(limit + 1))).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None:
+        rows.reverse() # always return oldest -> newest
+
+    next_cursor = None
+    if has_more:
+        # before/latest pages continue from the oldest row, after pages from the newest
+        next_cursor = rows[-1][0].id if after_id is not None else rows[0][0].id
+
+    return model.MessagePage(
+        messages = [message_out(mess, username) for mess, username in rows],
+        next_cursor = next_cursor
+    )
+
+@chats.get("/chats/{chat_id}/online", response_model=model.PresenceOut)
+async def get_online_members(chat_id : int, user_id : int = Depends(get_current_user_id)):
+    # straight from the websocket presence tracker, the db is only hit on an admission cache miss
+    _, allowed = await admission_cache.admit(user_id, [chat_id])
+    if chat_id not in allowed:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not a member of this chat")
+
+    return model.PresenceOut(
+        chat_id = chat_id,
+        online = [model.OnlineMember(id = member_id, username = username) for member_id, username in manager.presence.online(chat_id)]
+    )
 
 @chats.patch("/chats/{chat_id}", response_model=model.ChatOut)
-def new_chat_name(chat_id : int, chat_info_new : model.ChatIn, user_id : int = Depends(get_current_user_id), db : Session = Depends(get_db)):
+async def new_chat_name(chat_id : int, chat_info_new : model.ChatIn, user_id : int = Depends(get_current_user_id), db : AsyncSession = Depends(get_async_db)):
     
-    subject_chat = db.query(Chat).filter_by(id = chat_id).first()
+    subject_chat = (await db.execute(
+        select(Chat).options(
+            selectinload(Chat.memberships).selectinload(Membership.user)
+        ).filter_by(id = chat_id)
+    )).scalars().first()
 
     if not subject_chat or subject_chat is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
@@ -96,8 +151,9 @@ def new_chat_name(chat_id : int, chat_info_new : model.ChatIn, user_id : int = D
     
     subject_chat.name = chat_info_new.new_name
 
-    db.commit() # object is already tracked, so db.add() is not needed
-    db.refresh(subject_chat)
+    await db.commit() # object is already tracked, so db.add() is not needed
+
+    initial_messages = await recent_messages.get_many(db, [subject_chat.id])
 
     return {
         "name" : subject_chat.name,
@@ -111,20 +167,14 @@ def new_chat_name(chat_id : int, chat_info_new : model.ChatIn, user_id : int = D
                     creator = True if mem.user.id == subject_chat.creator_id else False
                 ) for mem in subject_chat.memberships
             ],
-        "initial_messages" : [
-            model.MessageOut(
-                username = mess.creator.username,
-                contents = mess.content,
-                timestamp = str(mess.time_sent)
-            ) for mess in sorted(subject_chat.messages, key=lambda x: x.time_sent)[-10:] 
-        ],
+        "initial_messages" : initial_messages[subject_chat.id],
         "id" : subject_chat.id
     }
 
 @chats.delete("/chats/{chat_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_chat(chat_id : int, user_id : int = Depends(get_current_user_id), db : Session = Depends(get_db)):
+async def delete_chat(chat_id : int, user_id : int = Depends(get_current_user_id), db : AsyncSession = Depends(get_async_db)):
     
-    subject_chat = db.query(Chat).filter_by(id = chat_id).first()
+    subject_chat = (await db.execute(select(Chat).filter_by(id = chat_id))).scalars().first()
     if not subject_chat or subject_chat is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
     
@@ -134,7 +184,8 @@ def delete_chat(chat_id : int, user_id : int = Depends(get_current_user_id), db
     if not is_owner:
         raise HTTPException(status_code = status.HTTP_403_FORBIDDEN, detail="You must be an owner to delete this chat")
     
-    db.delete(subject_chat)
-    db.commit()
+    await db.delete(subject_chat) # async because the cascade has to load memberships/messages
+    await db.commit()
+    admission_cache.forget_chat(chat_id)
 
     return None
@@ -0,0 +1,43 @@
+from fastapi import APIRouter
+
+from database.message_writer import message_writer
+from database.read_cursors import read_cursors
+from routes.websocket import manager
+from utils.admission_cache import admission_cache
+from utils.message_cache import recent_messages
+from utils.sent_messages import sent_messages
+from utils.passwords import password_hasher
+from utils.token_cache import verified_tokens
+
+metrics = APIRouter()
+
+# async on purpose - these read dicts/deques the event loop mutates (rooms, presence, caches),
+# and a sync route would iterate them from the thread pool, racing it ("dict changed size")
+@metrics.get("/metrics")
+async def get_metrics():
+    return {
+        "persistence" : message_writer.stats(),
+        "read_cursors" : read_cursors.stats(),
+        "recent_messages" : recent_messages.stats(),
+        "admission" : admission_cache.stats(),
+        "client_msg_ids" : sent_messages.stats(),
+        "passwords" : password_hasher.stats(),
+        "access_tokens" : verified_tokens.stats(),
+        "websockets" : {
+            "rooms" : len(manager.active_connections),
+            "connections" : len(manager.connections),
+            "room_memberships" : sum(len(room) for room in manager.active_connections.values()),
+            "evicted" : manager.evicted,
+            "replayed" : manager.replayed,
+            "resyncs" : manager.resyncs,
+            "coalescing_rooms" : sum(1 for traffic in manager.traffic.values() if traffic.pending is not None),
+            "batches" : manager.batches,
+            "batched_events" : manager.batched_events,
+            "pings" : manager.pings,
+            "reaped" : manager.reaped,
+            "reaped_last_sweep" : manager.reaped_last_sweep,
+            "read_receipts" : manager.read_receipts,
+        },
+        "presence" : manager.presence.stats(),
+        "unread" : manager.unread.stats(),
+    }
@@ -1,26 +1,28 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 import utils.pydantic_models as model 
 
-from sqlalchemy.orm import Session
-from sqlalchemy import or_
-from database.database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import or_, select
+from database.database import get_async_db
 from database.models import User
 
 from utils.auth import create_access_token, verify_access_token
+from utils.passwords import password_hasher
 
 sessions = APIRouter()
 
 @sessions.post("/sessions")
-def new_session(user_info : model.UserIn, db : Session = Depends(get_db)):
-    user_db = db.query(User).filter(
+async def new_session(user_info : model.UserIn, db : AsyncSession = Depends(get_async_db)):
+    user_db = (await db.execute(select(User).filter(
         or_(
             User.email==user_info.email, 
             User.username == user_info.username
         )
-    ).first()
+    ))).scalars().first()
 
     # deny the user access if not the right email/username or password
-    if not user_db or not user_db.check_password(user_info.password):
+    # (argon2 verify is slow, it runs in the password process pool)
+    if not user_db or not await password_hasher.verify(user_info.password, user_db.password_hash):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect username/email or password.")
     
     # Create JWT token & return it
@@ -1,8 +1,15 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 
-from sqlalchemy.orm import Session
-from database.database import get_db
-from database.models import User, Chat, Message, Membership
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import get_async_db
+from database.queries import adjust_member_count, newest_message_seq, UNREAD_COUNT_CAP
+from routes.websocket import manager
+from utils.message_cache import recent_messages
+from utils.admission_cache import admission_cache
+from utils.passwords import password_hasher
+from database.models import User, Chat, ChatSummary, Message, Membership
 
 import utils.pydantic_models as models
 
@@ -17,116 +24,135 @@ users = APIRouter()
 
 
 @users.post("/users", status_code=status.HTTP_201_CREATED, response_model=models.UserOut)
-def new_user(
+async def new_user(
     user_info : models.UserCreate, 
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
     ):
 
     normalised_email = user_info.email.strip().lower()
 
-    if db.query(User).filter_by(email = normalised_email).first():
+    if (await db.execute(select(User).filter_by(email = normalised_email))).scalars().first():
         # see if the user already exists
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT, 
             detail="This email already exists. Please try to log in with it."
         ) # 409 = conflict error
     
+    # hash first (argon2 is slow, it runs in the password process pool) - outside the try so
+    # a full pool's 503 reaches the client as is
+    password_hash = await password_hasher.hash(user_info.password)
+
     try:
         # enter the user into the database
         created_user = User(
             username = user_info.username,
-            email = normalised_email
+            email = normalised_email,
+            password_hash = password_hash
         )
-        # set password
-        created_user.set_password(user_info.password)
 
         db.add(created_user)
 
         
 
-        db.commit()
-        db.refresh(created_user)
+        await db.commit()
+        await db.refresh(created_user)
         
         return created_user # return is for successful responses, raise is for errors
     
     except Exception as e:
 
-        db.rollback()
+        await db.rollback()
         logger.error(f"[ERROR CREATING USER ({normalised_email})] -> {str(e)}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
             detail=f"An error occurred while creating the user")
 
 @users.get("/users/memberships", response_model=list[models.ChatOut])
-def get_all_user_chats(user_id : int = Depends(get_current_user_id), db : Session = Depends(get_db)):
-    # find all chats for this user
+async def get_all_user_chats(user_id : int = Depends(get_current_user_id), db : AsyncSession = Depends(get_async_db)):
+    # a fixed number of queries no matter how many chats/messages there are:
+    # chats + their summary rows, memberships, their users (selectinload) and the latest messages for every chat at once
     try:
-        user_chats = [chat for chat in (
-            db.query(Chat, Membership.pinned)
+        user_chats = (await db.execute(
+            select(Chat, Membership.pinned, ChatSummary)
+            .options(selectinload(Chat.memberships).selectinload(Membership.user))
             .join(Membership, Chat.id == Membership.chat_id)
+            .outerjoin(ChatSummary, ChatSummary.chat_id == Chat.id)
             .filter(
                 Membership.user_id == user_id
             )
             .order_by(
                 Membership.pinned.desc(),
+                ChatSummary.last_activity_at.desc().nulls_last(), # most recently active first
                 Chat.name
             )
-        )]
-        
-        if not user_chats or len(user_chats) == 0:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No chats could be found for this user")
-
-        results = [
-            models.ChatOut(
-                name=chat[0].name,
-                is_creator = True if chat[0].creator_id == user_id else False,
-                pinned = chat[1],
-                members = [
-                    models.Member(
-                        id = mem.user.id,
-                        username = mem.user.username,
-                        email = mem.user.email,
-                        creator = True if mem.user.id == chat[0].creator_id else False
-                    ) for mem in chat[0].memberships
-                ],
-                initial_messages = [
-                    models.MessageOut(
-                        sender = mess.creator.username,
-                        contents = mess.content,
-                        timestamp = str(mess.time_sent)
-                    ) for mess in sorted(chat[0].messages, key=lambda x: x.time_sent)[-10:] 
-                ]
-            ) for chat in user_chats
-        ]
-        return results  
+        )).all()
+
+        # hot rooms come straight from memory, everything else in one query
+        latest_messages = await recent_messages.get_many(db, [chat.id for chat, _, _ in user_chats])
+        unread = await manager.unread.counts(db, user_id) # same again
     except Exception as e:
         logger.error(f"unexpected error -> {e}")
         raise HTTPException(status_code = status.HTTP_500_INTERNAL_SERVER_ERROR, detail = f"unexpected error -> {e}")
-    
-
-    
-    
-    # find last 20 messages
+        
+    if not user_chats or len(user_chats) == 0:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No chats could be found for this user")
+
+    return [
+        models.ChatOut(
+            id = chat.id,
+            name = chat.name,
+            is_creator = True if chat.creator_id == user_id else False,
+            pinned = bool(pinned),
+            members = [
+                models.Member(
+                    id = mem.user.id,
+                    username = mem.user.username,
+                    email = mem.user.email,
+                    creator = True if mem.user.id == chat.creator_id else False
+                ) for mem in chat.memberships
+            ],
+            initial_messages = latest_messages[chat.id],
+            message_count = summary.message_count if summary else 0,
+            last_activity = str(summary.last_activity_at) if summary else None,
+            unread = min(unread.get(chat.id, 0), UNREAD_COUNT_CAP),
+            unread_capped = unread.get(chat.id, 0) > UNREAD_COUNT_CAP
+        ) for chat, pinned, summary in user_chats
+    ]
+
+@users.get("/users/memberships/unread", response_model=list[models.UnreadCount])
+async def get_unread_counts(user_id : int = Depends(get_current_user_id), db : AsyncSession = Depends(get_async_db)):
+    # cheap enough to poll: one query for chats that aren't live on this worker, memory for the rest
+    unread = await manager.unread.counts(db, user_id)
+    return [
+        models.UnreadCount(chat_id = chat_id, unread = min(count, UNREAD_COUNT_CAP), capped = count > UNREAD_COUNT_CAP)
+        for chat_id, count in sorted(unread.items())
+    ]
 
 @users.post("/users/membership/{chat_id}", status_code = status.HTTP_201_CREATED, response_model=models.Member)
-def join_chat(
+async def join_chat(
     chat_id : int, 
     user_id : int = Depends(get_current_user_id), 
-    db : Session=Depends(get_db)
+    db : AsyncSession=Depends(get_async_db)
     ):
 
-    joining_chat = db.query(Chat).filter_by(id = chat_id).first()
+    joining_chat = (await db.execute(select(Chat).filter_by(id = chat_id))).scalars().first()
 
     if not joining_chat or joining_chat == None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail = "Chat could not be found")
     
+    # everything already in the chat starts out read, or a new member's first sight of it is "99+".
+    # the live window can be ahead of the messages the writer has stored
+    newest_seq = max(await newest_message_seq(db, chat_id), manager.newest_seq(chat_id) or 0)
     new_membership = Membership(
         chat_id = joining_chat.id,
-        user_id = user_id
+        user_id = user_id,
+        last_read_seq = newest_seq
     )
     db.add(new_membership)
-    db.commit()
-    db.refresh(new_membership)
+    await adjust_member_count(db, joining_chat.id, 1)
+    await db.commit()
+    admission_cache.forget_member(joining_chat.id, user_id) # may have been cached as "not a member"
+    await db.refresh(new_membership, attribute_names=["user", "chat"])
 
     return {
         "id" : new_membership.user.id,
@@ -137,14 +163,18 @@ def join_chat(
     }
     
 @users.patch("/users/memberships/{chat_id}", response_model=models.ChatOut)
-def change_pinned_status(
+async def change_pinned_status(
     chat_id : int, 
     new_chat_info : models.ChatIn, 
     user_id : int = Depends(get_current_user_id),
-    db : Session=Depends(get_db)
+    db : AsyncSession=Depends(get_async_db)
     ):
 
-    subject_chat = db.query(Chat).filter_by(id = chat_id).first()
+    subject_chat = (await db.execute(
+        select(Chat).options(
+            selectinload(Chat.memberships).selectinload(Membership.user)
+        ).filter_by(id = chat_id)
+    )).scalars().first()
 
     if not subject_chat:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found")
@@ -160,8 +190,9 @@ def change_pinned_status(
     
     subject_chat_membership.pinned = new_chat_info.pinned
 
-    db.commit()
-    db.refresh(subject_chat_membership)
+    await db.commit()
+
+    initial_messages = await recent_messages.get_many(db, [subject_chat.id])
 
     return {
         "name" : subject_chat.name,
@@ -175,26 +206,23 @@ def change_pinned_status(
                     creator = True if mem.user.id == subject_chat.creator_id else False
                 ) for mem in subject_chat.memberships
             ],
-        "initial_messages" : [
-            models.MessageOut(
-                username = mess.creator.username,
-                contents = mess.content,
-                timestamp = str(mess.time_sent)
-            ) for mess in sorted(subject_chat.messages, key=lambda x: x.time_sent)[-10:] 
-        ]
+        "initial_messages" : initial_messages[subject_chat.id],
+        "id" : subject_chat.id
     }
 
 @users.delete("/users/memberships/{chat_id}", status_code=status.HTTP_204_NO_CONTENT)
-def leave_chat(
+async def leave_chat(
     chat_id : int, 
     user_id : int = Depends(get_current_user_id),
-    db : Session=Depends(get_db)
+    db : AsyncSession=Depends(get_async_db)
     ):
     
-    subject_membership = db.query(Membership).filter_by(
-        chat_id = chat_id,
-        user_id = user_id
-    ).first()
+    subject_membership = (await db.execute(
+        select(Membership).options(selectinload(Membership.chat)).filter_by(
+            chat_id = chat_id,
+            user_id = user_id
+        )
+    )).scalars().first()
 
     if not subject_membership or subject_membership is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Membership not found.")
@@ -204,7 +232,9 @@ def leave_chat(
             status_code=status.HTTP_403_FORBIDDEN, 
             detail="You cannot leave this chat as the owner. Try deleting it instead.")
     
-    db.delete(subject_membership)
-    db.commit()
+    await db.delete(subject_membership)
+    await adjust_member_count(db, chat_id, -1)
+    await db.commit()
+    admission_cache.forget_member(chat_id, user_id)
 
     return None
\ No newline at end of file
@@ -1,14 +1,18 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query, Depends
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
 from utils.auth import verify_access_token
 from jose import JWTError
 
-import json, pytz
+import asyncio, functools, json, os, pytz, time
 
+from collections import deque
 from datetime import datetime
 
-from sqlalchemy.orm import Session
-from database.database import get_db
+from sqlalchemy import select
+from database.database import session_scope
+from database.message_writer import message_writer
+from database.read_cursors import read_cursors
 from database.models import User, Chat, Message, Membership
+from database.queries import format_timestamp, messages_after_seq, newest_message_seq
 
 import utils.pydantic_models as models
 
@@ -16,128 +20,767 @@ import utils.pydantic_models as models
 from utils.debug_utils import logger
 from utils.auth import get_current_user_id
 
-from typing import List, Dict
+from utils.admission_cache import admission_cache
+from utils.broker import Broker, create_broker
+from utils.outbound import Connection
+from utils.presence import PresenceTracker
+from utils.sent_messages import CLIENT_MSG_ID_MAX_LENGTH, Sent, sent_messages
+from utils.snowflake import snowflake
+from utils.unread import UnreadCounts
+from utils.message_cache import recent_messages
+from utils.wire import Frame, JSON, negotiate, receive_frame
+
+from typing import Deque, List, Dict, Optional, Set
+
+BRISBANE = pytz.timezone("Australia/Brisbane")
+
+WS_MAX_SUBSCRIPTIONS = int(os.getenv("WS_MAX_SUBSCRIPTIONS", "500")) # chats per multiplexed socket
+WS_REPLAY_WINDOW = int(os.getenv("WS_REPLAY_WINDOW", "256")) # recent events kept per live chat for resume_from
+WS_REPLAY_DB_LIMIT = int(os.getenv("WS_REPLAY_DB_LIMIT", "500")) # bigger gaps than this get a resync instead
+
+# sockets quiet for WS_HEARTBEAT_INTERVAL seconds get a {"type": "ping"}, quiet for
+# WS_HEARTBEAT_TIMEOUT they're reaped if they've ever pinged/ponged (0 turns heartbeats off)
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+WS_HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", "60"))
+HEARTBEAT_CLOSE_CODE = 4009
+
+# rooms busier than WS_COALESCE_RATE events/s get their events batched every WS_COALESCE_WINDOW_MS (0 turns it off)
+WS_COALESCE_RATE = float(os.getenv("WS_COALESCE_RATE", "100"))
+WS_COALESCE_WINDOW_MS = int(os.getenv("WS_COALESCE_WINDOW_MS", "20"))
+
+# read positions are passed on to each room at most once every WS_READ_RECEIPT_INTERVAL_MS
+WS_READ_RECEIPT_INTERVAL_MS = int(os.getenv("WS_READ_RECEIPT_INTERVAL_MS", "1000"))
+
+
+class _Traffic:
+    """Event rate for one room, and its pending batch while it's coalescing."""
+    __slots__ = ("window_start", "count", "rate", "pending")
+
+    def __init__(self, now : float):
+        self.window_start = now
+        self.count = 0 # events since window_start
+        self.rate = 0.0 # events/s over the last full second
+        self.pending: Optional[List[dict]] = None # events waiting for the next batch, None when not coalescing
+
+    def tick(self, now : float):
+        elapsed = now - self.window_start
+        if elapsed >= 1:
+            self.rate = self.count / elapsed
+            self.window_start = now
+            self.count = 0
+        self.count += 1
+
 
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[int, List[WebSocket]] = {}
+    """
+    Routes room events to sockets. A Connection can be in any number of rooms -
+    /ws/{chat_id} sockets sit in exactly one, multiplexed /ws sockets in every chat
+    they've subscribed to.
+
+    Every event carries its chat's seq (see utils/broker.py). The last WS_REPLAY_WINDOW
+    events of each live chat are kept so a client reconnecting with resume_from=<seq>
+    gets just what it missed; older gaps are filled from the messages table, and gaps
+    too big for that get a {"type": "resync"} telling the client to reload over REST.
+
+    Quiet rooms send every event as its own frame straight away. Once a room goes over
+    coalesce_rate events/s, its events are collected for coalesce_window_ms and sent as
+    one {"type": "batch", "chat_id": ..., "events": [...]} frame, which saves a frame
+    (and a send per socket) per event at the cost of up to one window of latency.
+
+    A dead peer (a phone that lost signal, a half-open TCP connection) never sends a
+    disconnect, so a reaper sweeps every heartbeat_interval: sockets that haven't sent
+    anything for that long get a {"type": "ping"} (clients answer {"type": "pong"}),
+    and sockets silent for heartbeat_timeout are dropped from every room in one go.
+    Only sockets that have sent a ping or pong of their own are ever dropped - clients
+    that just read never answer, and are left to uvicorn's protocol-level ping
+    (--ws-ping-interval / --ws-ping-timeout).
+
+    Who's online comes from the presence tracker (utils/presence.py), not from sockets.
+    It replaces the old per-tab user_joined/user_left events with one
+    {"type": "presence", "chat_id": ..., "online": [{"id", "username"}], "offline": [ids]}
+    diff per room per flush interval - a user is online from their first socket until
+    their last one has been gone for the grace period. Joining sockets get the list as
+    of the last diff straight away, as a presence frame with "snapshot": true. Presence
+    is per worker: diffs go to this worker's sockets only, never through the broker.
+
+    Read positions work the same way: they're collected per room and sent as one
+    {"type": "read", "chat_id": ..., "reads": [{"id", "seq"}]} receipt at most every
+    read_receipt_interval_ms, however fast members scroll.
+    """
+    def __init__(
+        self,
+        broker : Broker,
+        coalesce_rate : float = WS_COALESCE_RATE,
+        coalesce_window_ms : int = WS_COALESCE_WINDOW_MS,
+        heartbeat_interval : float = WS_HEARTBEAT_INTERVAL,
+        heartbeat_timeout : float = WS_HEARTBEAT_TIMEOUT,
+        read_receipt_interval_ms : int = WS_READ_RECEIPT_INTERVAL_MS
+        ):
+        self.connections: Set[Connection] = set() # every open socket, in rooms or not
+        self.active_connections: Dict[int, Set[Connection]] = {} # sets -> O(1) join/leave however big the room
+        self.replay: Dict[int, Deque[Frame]] = {}
+        self.traffic: Dict[int, _Traffic] = {}
+        self.broker = broker
+        self.coalesce_rate = coalesce_rate
+        self.coalesce_window = coalesce_window_ms / 1000
+        self.evicted = 0 # slow consumers disconnected by their queue policy
+        self.replayed = 0 # events replayed to resuming sockets
+        self.resyncs = 0
+        self.batches = 0 # coalesced frames sent
+        self.batched_events = 0 # events that went out inside them
+
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.reaper_task: Optional[asyncio.Task] = None
+        self.reaped = 0 # total sockets reaped
+        self.reaped_last_sweep = 0
+        self.pings = 0
+
+        self.presence = PresenceTracker(self._presence_changed)
+        self.presence_frames: Dict[int, Frame] = {}
+
+        self.read_receipt_interval = read_receipt_interval_ms / 1000
+        self.reads: Dict[int, Dict[int, int]] = {} # chat_id -> {user_id: seq} waiting for the room's next read receipt
+        self.read_receipts = 0
+        self.unread = UnreadCounts(self.replay)
+
+    async def start(self):
+        await self.broker.start(self.deliver)
+        if self.heartbeat_interval:
+            self.reaper_task = asyncio.get_running_loop().create_task(self._reaper())
+
+    async def stop(self):
+        if self.reaper_task is not None:
+            self.reaper_task.cancel()
+            try:
+                await self.reaper_task
+            except asyncio.CancelledError:
+                pass
+            self.reaper_task = None
+        await self.broker.stop()
     
-    async def connect(self, websocket : WebSocket, chat_id : int):
-        await websocket.accept()
+    async def connect(self, websocket : WebSocket, chat_id : Optional[int] = None) -> Connection:
+        wire_format = negotiate(websocket)
+        await websocket.accept(subprotocol=wire_format)
+
+        connection = Connection(websocket, wire_format=wire_format or JSON, on_evict=self._evict)
+        connection.start()
+        self.connections.add(connection)
+
+        if chat_id is not None:
+            await self.join(connection, chat_id)
+
+        return connection
+
+    async def join(self, connection : Connection, chat_id : int, resume_from : Optional[int] = None):
+        if resume_from is None:
+            await self._join(connection, chat_id)
+        else:
+            # live events that arrive while the replay is being put together wait behind it
+            connection.hold()
+            last = None
+            try:
+                await self._join(connection, chat_id)
+                last = await self._replay(connection, chat_id, resume_from)
+            finally:
+                connection.release({chat_id : last})
+
+        connection.enqueue(self._presence_snapshot(chat_id))
+
+    def _presence_snapshot(self, chat_id : int) -> Frame:
+        # what the room was last told, so the diffs that follow apply to it cleanly. Built once
+        # per change and shared, or a room reconnecting all at once costs O(members^2)
+        frame = self.presence_frames.get(chat_id)
+        if frame is None:
+            frame = self.presence_frames[chat_id] = Frame({
+                "type" : "presence",
+                "chat_id" : chat_id,
+                "online" : [{"id" : user_id, "username" : username} for user_id, username in self.presence.announced(chat_id)],
+                "offline" : [],
+                "snapshot" : True
+            })
+        return frame
+
+    async def _join(self, connection : Connection, chat_id : int):
+        if chat_id in connection.chat_ids:
+            return
+        connection.chat_ids.add(chat_id)
         
-        # Create list for this chat_id if it doesn't exist
+        # Create set for this chat_id if it doesn't exist
         if chat_id not in self.active_connections:
-            self.active_connections[chat_id] = []
+            self.active_connections[chat_id] = set()
 
-        self.active_connections[chat_id].append(websocket)
+        self.active_connections[chat_id].add(connection)
         print(f"Client connected to chat {chat_id}. Total in room: {len(self.active_connections[chat_id])}")
+        if connection.user_id is not None:
+            self.presence.connected(chat_id, connection.user_id, connection.username)
+
+        # first socket for this chat on this worker -> start receiving its events
+        if len(self.active_connections[chat_id]) == 1:
+            recent_messages.track(chat_id)
+            self.replay.setdefault(chat_id, deque(maxlen=WS_REPLAY_WINDOW))
+            await self.broker.subscribe(chat_id)
+
+    async def _replay(self, connection : Connection, chat_id : int, resume_from : int) -> Optional[int]:
+        """Queue everything after resume_from. Returns the last seq sent, None after a resync."""
+        window = list(self.replay.get(chat_id, ()))
+
+        if window and resume_from > window[-1].event["seq"]:
+            # client is ahead of us - seqs survive restarts, so the db was restored or similar and its seqs mean nothing any more
+            return self._resync(connection, chat_id)
+
+        if window and window[0].event["seq"] <= resume_from + 1:
+            frames = [frame for frame in window if frame.event["seq"] > resume_from]
+        else:
+            # gap starts before the window, fill it from the db. Only messages are persisted,
+            # so system events from the gap are skipped, and messages the writer hasn't
+            # flushed yet (the last few ms) can be missed
+            oldest = window[0].event["seq"] if window else None
+            async with session_scope() as db:
+                rows = await messages_after_seq(db, chat_id, resume_from, oldest, WS_REPLAY_DB_LIMIT + 1)
+            if len(rows) > WS_REPLAY_DB_LIMIT:
+                return self._resync(connection, chat_id)
+            frames = [Frame(stored_message_event(mess, username)) for mess, username in rows]
+            frames += [frame for frame in window if frame.event["seq"] > resume_from]
+
+        for frame in frames:
+            connection.enqueue_now(frame)
+        self.replayed += len(frames)
+        return frames[-1].event["seq"] if frames else resume_from
+
+    def newest_seq(self, chat_id : int) -> Optional[int]:
+        """Newest seq delivered in chat_id on this worker, None if nothing has been since it went live here."""
+        window = self.replay.get(chat_id)
+        return window[-1].event["seq"] if window else None
+
+    def _resync(self, connection : Connection, chat_id : int) -> None:
+        self.resyncs += 1
+        connection.enqueue_now(Frame({"type" : "resync", "chat_id" : chat_id}))
+        return None
+
+    def _remove(self, connection : Connection, chat_id : int):
+        connection.chat_ids.discard(chat_id)
+        room = self.active_connections.get(chat_id)
+        if room is None or connection not in room:
+            return # already gone, e.g. evicted
+        
+        room.remove(connection)
+        print(f"Client disconnected from chat {chat_id}. Total in room: {len(room)}")
+        if connection.user_id is not None:
+            self.presence.disconnected(chat_id, connection.user_id)
+
+        # Clean up empty chatrooms
+        if len(room) == 0:
+            del self.active_connections[chat_id]
+
+    async def _unsubscribe_if_empty(self, chat_id : int):
+        # re-checked here because someone may have joined while a removal was pending
+        if chat_id not in self.active_connections:
+            recent_messages.drop(chat_id)
+            self.replay.pop(chat_id, None) # would have holes once we stop listening
+            self.traffic.pop(chat_id, None)
+            self.presence_frames.pop(chat_id, None)
+            self.unread.drop(chat_id)
+            await self.broker.unsubscribe(chat_id)
+
+    def _detach(self, connection : Connection):
+        """Take a connection out of every room without waiting, unsubscribing in the background."""
+        self.connections.discard(connection)
+        for chat_id in list(connection.chat_ids):
+            self._remove(connection, chat_id)
+            asyncio.get_running_loop().create_task(self._unsubscribe_if_empty(chat_id))
+
+    def _evict(self, connection : Connection):
+        self.evicted += 1
+        self._detach(connection)
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"websocket reaper sweep failed -> {e}")
+
+    def reap(self) -> int:
+        """One sweep: ping quiet sockets, drop silent ones. Returns how many were dropped."""
+        now = time.monotonic()
+        ping = None
+        stale = []
+        for connection in tuple(self.connections): # a ping can evict a slow consumer, which detaches it
+            idle = now - connection.last_seen
+            if idle >= self.heartbeat_timeout and connection.heartbeats:
+                stale.append(connection)
+            elif idle >= self.heartbeat_interval:
+                ping = ping or Frame({"type" : "ping"}) # one frame per sweep, shared like a broadcast
+                connection.enqueue(ping)
+                self.pings += 1
+
+        loop = asyncio.get_running_loop()
+        for connection in stale:
+            self._detach(connection)
+            # the endpoint's receive loop gets the disconnect and finishes cleaning up
+            loop.create_task(connection.close(code=HEARTBEAT_CLOSE_CODE, reason="Heartbeat timeout"))
+
+        self.reaped += len(stale)
+        self.reaped_last_sweep = len(stale)
+        if stale:
+            logger.info(f"reaped {len(stale)} silent websockets")
+        return len(stale)
+
+    def _presence_changed(self, chat_id : int, came_online : Dict[int, str], went_offline : Dict[int, str]):
+        self.presence_frames.pop(chat_id, None)
+        self._announce(chat_id, came_online, went_offline)
+
+    def _announce(self, chat_id : int, came_online : Dict[int, str], went_offline : Dict[int, str]):
+        # one event however many changed - after a deploy a whole room comes back at once.
+        # Local sockets only, not through the broker: the counts are this worker's, and another
+        # worker's "offline" would wrongly cancel a user still connected here. Unnumbered, a
+        # resuming client gets a fresh snapshot anyway
+        self._fan_out(chat_id, Frame({
+            "type" : "presence",
+            "chat_id" : chat_id,
+            "online" : [{"id" : user_id, "username" : username} for user_id, username in came_online.items()],
+            "offline" : list(went_offline)
+        }))
+
+    def share_read(self, chat_id : int, user_id : int, seq : int):
+        reads = self.reads.get(chat_id)
+        if reads is None:
+            reads = self.reads[chat_id] = {}
+            asyncio.get_running_loop().call_later(self.read_receipt_interval, self._flush_reads, chat_id)
+        if seq > reads.get(user_id, -1):
+            reads[user_id] = seq
+
+    def _flush_reads(self, chat_id : int):
+        reads = self.reads.pop(chat_id, None)
+        if not reads:
+            return
+        self.read_receipts += 1
+        asyncio.get_running_loop().create_task(self.broadcast({
+            "type" : "read",
+            "chat_id" : chat_id,
+            "reads" : [{"id" : user_id, "seq" : seq} for user_id, seq in reads.items()]
+        }, chat_id))
+
+    async def leave(self, connection : Connection, chat_id : int):
+        self._remove(connection, chat_id)
+        await self._unsubscribe_if_empty(chat_id)
     
-    def disconnect(self, websocket : WebSocket, chat_id : int):
-        if chat_id in self.active_connections:
-            self.active_connections[chat_id].remove(websocket)
-            print(f"Client disconnected from chat {chat_id}. Total in room: {len(self.active_connections[chat_id])}")
+    async def disconnect(self, connection : Connection):
+        self.connections.discard(connection)
+        for chat_id in list(connection.chat_ids):
+            await self.leave(connection, chat_id)
+        await connection.stop()
+
+    async def broadcast(self, event : dict, chat_id : int) -> Optional[int]:
+        # goes through the broker so sockets on other workers get it too. Returns the event's seq
+        return await self.broker.publish(chat_id, event)
+
+    async def deliver(self, chat_id : int, event : dict):
+        # called by the broker for events in chats this worker is subscribed to.
+        # only enqueues - each connection's writer task does the actual sending
+        if event.get("type") == "message":
+            recent_messages.append(chat_id, models.MessageOut(
+                id = event.get("id"),
+                sender = event["sender"],
+                contents = event["content"],
+                timestamp = event["timestamp"],
+                seq = event.get("seq")
+            ))
+
+        frame = Frame(event) # encoded once per wire format, shared by every socket
+        if event.get("seq") is not None and chat_id in self.replay:
+            self.replay[chat_id].append(frame)
+            if event.get("type") == "message":
+                self.unread.message(chat_id, event.get("sender_id"), event["seq"])
+            elif event.get("type") == "read":
+                for read in event["reads"]: # receipts from every worker, not just this one
+                    self.unread.read(chat_id, read["id"], read["seq"])
+
+        if self._coalescing(chat_id, event):
+            return # goes out with the room's next batch
+
+        self._fan_out(chat_id, frame)
+
+    def _fan_out(self, chat_id : int, frame : Frame):
+        # snapshot - enqueue can evict a slow consumer, which changes the room
+        for connection in tuple(self.active_connections.get(chat_id, ())):
+            connection.enqueue(frame)
+
+    def _coalescing(self, chat_id : int, event : dict) -> bool:
+        """Track the room's rate and add the event to its pending batch if it's busy."""
+        if not self.coalesce_rate or chat_id not in self.active_connections:
+            return False
+
+        loop = asyncio.get_running_loop()
+        traffic = self.traffic.get(chat_id)
+        if traffic is None:
+            traffic = self.traffic[chat_id] = _Traffic(loop.time())
+        traffic.tick(loop.time())
+
+        if traffic.pending is None:
+            if traffic.rate < self.coalesce_rate and traffic.count < self.coalesce_rate:
+                return False
+            traffic.pending = []
+            loop.call_later(self.coalesce_window, self._flush_batch, chat_id)
+
+        # once a batch is open everything joins it, so events never overtake each other
+        traffic.pending.append(event)
+        return True
 
-            # Clean up empty chatrooms
-            if len(self.active_connections[chat_id]) == 0:
-                del self.active_connections[chat_id]
+    def _flush_batch(self, chat_id : int):
+        traffic = self.traffic.get(chat_id)
+        if traffic is None or not traffic.pending:
+            return # room went away
+        events, traffic.pending = traffic.pending, None
 
-    async def broadcast(self, message : str, chat_id : int):
-        if chat_id in self.active_connections:
-            for connection in self.active_connections[chat_id]:
-                await connection.send_text(message)
+        self.batches += 1
+        self.batched_events += len(events)
+        if len(events) == 1:
+            self._fan_out(chat_id, Frame(events[0]))
+        else:
+            self._fan_out(chat_id, Frame({"type" : "batch", "chat_id" : chat_id, "events" : events}))
 
-manager = ConnectionManager()
+    def send(self, connection : Connection, event : dict):
+        """Send an event to just this socket (control replies, errors)."""
+        connection.enqueue(Frame(event))
+
+manager = ConnectionManager(create_broker())
 
 router = APIRouter()
 
+
+# -----------------------------------------------------------------------------------------
+# SHARED BY BOTH ENDPOINTS ----------------------------------------------------------------
+
+def authenticate(token : str) -> Optional[int]:
+    """user_id from the token, or None if it's invalid/expired"""
+    try:
+        payload = verify_access_token(token)
+        return payload.get("user_id")
+    except Exception:
+        return None
+
+async def control(connection : Connection, frame, chat_id : Optional[int] = None) -> bool:
+    """
+    Handle {"type": "pong"} / {"type": "ping"} / {"type": "read"} / {"type": "message"}
+    frames, True if frame was one. On /ws/{chat_id}, where text frames are message
+    content, they're only recognised as JSON text (or msgpack maps), so a chat message
+    can't be mistaken for one unless it's that exact JSON. There a frame's chat_id is
+    the endpoint's.
+    """
+    if isinstance(frame, str):
+        if not frame.startswith("{"):
+            return False
+        try:
+            frame = json.loads(frame)
+        except ValueError:
+            return False
+    if not isinstance(frame, dict):
+        return False
+
+    kind = frame.get("type")
+    if kind == "pong":
+        connection.heartbeats = True # answers our pings, so silence means it's gone
+        return True # touch() already did the work
+    if kind == "ping":
+        connection.heartbeats = True
+        manager.send(connection, {"type" : "pong"})
+        return True
+    if kind == "read":
+        try:
+            await mark_read(connection, frame.get("chat_id") if chat_id is None else chat_id, frame.get("seq"))
+        except ValueError as e:
+            manager.send(connection, {"type" : "error", "detail" : str(e)})
+        return True
+    if kind == "message":
+        try:
+            await message_frame(connection, frame, chat_id)
+        except ValueError as e:
+            manager.send(connection, {"type" : "error", "detail" : str(e), "client_msg_id" : frame.get("client_msg_id")})
+        return True
+    return False
+
+async def message_frame(connection : Connection, frame : dict, chat_id : Optional[int] = None):
+    chat_id = frame.get("chat_id") if chat_id is None else chat_id
+    content, client_msg_id = frame.get("content"), frame.get("client_msg_id")
+    if chat_id not in connection.chat_ids:
+        raise ValueError("subscribe to a chat before sending to it")
+    if not isinstance(content, str):
+        raise ValueError("content must be a string")
+    if client_msg_id is not None and (not isinstance(client_msg_id, str) or not 0 < len(client_msg_id) <= CLIENT_MSG_ID_MAX_LENGTH):
+        raise ValueError(f"client_msg_id must be a string of 1-{CLIENT_MSG_ID_MAX_LENGTH} characters")
+    if client_msg_id is not None and "\x00" in client_msg_id:
+        raise ValueError("client_msg_id can't contain NUL characters")
+    await send_chat_message(connection, chat_id, content, client_msg_id)
+
+async def mark_read(connection : Connection, chat_id : int, seq : int):
+    """
+    The user has read chat_id up to seq. Persisted in bulk by database/read_cursors.py,
+    and passed on to the room in the manager's next read receipt.
+    """
+    if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+        raise ValueError("seq must be a non-negative integer")
+    if chat_id not in connection.chat_ids:
+        raise ValueError("subscribe to a chat before marking it read")
+
+    # no further than the chat has got - cursors only move forward, so one past the end
+    # would count every message still to come as read
+    newest = manager.newest_seq(chat_id)
+    if newest is None: # nothing delivered here since the chat went live, ask the db
+        async with session_scope() as db:
+            newest = await newest_message_seq(db, chat_id)
+    seq = min(seq, newest)
+
+    if read_cursors.submit(chat_id, connection.user_id, seq):
+        manager.share_read(chat_id, connection.user_id, seq)
+        manager.unread.read(chat_id, connection.user_id, seq) # the receipt takes a while to come back
+
+def stored_message_event(mess : Message, username : str) -> dict:
+    """A persisted message in the same shape as the live message event."""
+    return {
+        "type" : "message",
+        "id" : mess.id,
+        "chat_id" : mess.chat_id,
+        "sender" : username,
+        "sender_id" : mess.creator_id,
+        "content" : mess.content,
+        "timestamp" : format_timestamp(mess.time_sent),
+        "seq" : mess.seq
+    }
+
+def ack_event(client_msg_id : str, sent : Sent) -> dict:
+    return {"type" : "ack", "chat_id" : sent.chat_id, "client_msg_id" : client_msg_id, "id" : sent.message_id, "seq" : sent.seq}
+
+def _stored(user_id : int, client_msg_id : str, sent : Sent, message_id : Optional[int], seq : Optional[int]):
+    # message writer callback - ack everyone who sent it (the original and any resends)
+    waiters, sent.waiters = sent.waiters, []
+    if message_id is None:
+        sent_messages.forget(user_id, client_msg_id)
+        event = {"type" : "error", "detail" : "Message could not be saved, send it again", "client_msg_id" : client_msg_id}
+    else:
+        sent.message_id, sent.seq = message_id, seq # seq of the stored copy if this was a resend
+        event = ack_event(client_msg_id, sent)
+    for connection in waiters:
+        manager.send(connection, event)
+
+async def send_chat_message(connection : Connection, chat_id : int, content : str, client_msg_id : Optional[str] = None):
+    content = content.replace("\x00", "") # postgres text can't store NUL, and the copy we broadcast should match the stored one
+
+    # goes out with the id it'll be stored under - no waiting on the db
+    now = datetime.now(tz=BRISBANE)
+    message_id = snowflake.next_id()
+    message = {
+        "type" : "message",
+        "id" : message_id,
+        "chat_id" : chat_id,
+        "sender" : connection.username,
+        "sender_id" : connection.user_id,
+        "content" : content,
+        "timestamp" : format_timestamp(now)
+    }
+    if client_msg_id is not None:
+        message["client_msg_id"] = client_msg_id # so other tabs can tell a message they sent
+
+    if not manager.broker.fits(message):
+        # the postgres broker can't carry it to other workers. Checked before the client_msg_id
+        # is claimed, so a resend of it is turned away the same way
+        manager.send(connection, {"type" : "error", "detail" : "Message is too long", "client_msg_id" : client_msg_id})
+        return
+
+    sent = None
+    if client_msg_id is not None:
+        sent, new = sent_messages.claim(connection.user_id, client_msg_id, chat_id)
+        if not new:
+            # a resend - not broadcast or written again
+            if sent.message_id is not None:
+                manager.send(connection, ack_event(client_msg_id, sent))
+            elif connection not in sent.waiters:
+                sent.waiters.append(connection)
+            return
+        sent.waiters.append(connection)
+
+    print(f"Received from user {connection.username} in chat {chat_id}: {content}")
+
+    # broadcast to all connected clients
+    seq = await manager.broadcast(message, chat_id)
+
+    # written in batches in the background (see database/message_writer.py), acked once it's stored
+    await message_writer.submit({
+        "id" : message_id,
+        "chat_id" : chat_id,
+        "creator_id" : connection.user_id,
+        "content" : content,
+        "time_sent" : now,
+        "seq" : seq,
+        "client_msg_id" : client_msg_id
+    }, None if sent is None else functools.partial(_stored, connection.user_id, client_msg_id, sent))
+
+
 @router.websocket("/ws/{chat_id}")
 async def websocket_endpoint(
     chat_id : int, 
     websocket : WebSocket, 
     token : str = Query(...),  # query(...) means this parameter is required (?token=xyz expected)
-    db : Session=Depends(get_db)
+    resume_from : Optional[int] = Query(None) # last seq the client saw before reconnecting
     ):
 
     # verify token
-    try:
-        payload = verify_access_token(token)
-        user_id = payload.get("user_id")
-
-        if user_id is None:
-            await websocket.close(code=4001, reason="Invalid token")
-            return
-    
-    except Exception as e:
+    user_id = authenticate(token)
+    if user_id is None:
         # Token is invalid/expired
         await websocket.close(code=4001, reason="Authentication failed")
         return
 
-    # after that, accept connection
-    await manager.connect(websocket, chat_id)
+    # after that, accept connection (joins the room once membership is confirmed)
+    connection = await manager.connect(websocket)
 
-    # verify that the user is a member of this chat
-    membership = db.query(Membership).filter_by(
-        chat_id = chat_id,
-        user_id = user_id
-    ).first()
+    # verify that the user is a member of this chat, and get username for better messages.
+    # cached, and on a miss the session is only held for the lookups - an idle socket
+    # doesn't pin a pooled connection, messages are written by the message writer on its own sessions
+    username, allowed = await admission_cache.admit(user_id, [chat_id])
 
-    if not membership:
+    if chat_id not in allowed:
         await websocket.close(code=4003, reason="Not a member of this chat")
-        manager.disconnect(websocket, chat_id)
+        await manager.disconnect(connection)
         return
     
-    # get username for better messages
-    user = db.query(User).filter_by(id = user_id).first()
-    username = user.username if user else f"User {user_id}"
+    username = username or f"User {user_id}"
+    connection.user_id = user_id
+    connection.username = username
+    await manager.join(connection, chat_id, resume_from) # the room hears about us from the presence tracker
 
+    try:
+        while True:
+            data = await receive_frame(websocket, connection.wire_format)
+            connection.touch()
+            if await control(connection, data, chat_id):
+                continue
+            if not isinstance(data, str):
+                continue # message content is plain text in either format
 
-    # join event
-    join_message = {
-        "type": "user_joined",
-        "content": f"{username} joined the chat",
-        "timestamp": datetime.now(tz=pytz.timezone("Australia/Brisbane")).isoformat(),
-        "sender": "system"
-    }
-    await manager.broadcast(json.dumps(join_message), chat_id)
+            await send_chat_message(connection, chat_id, data)
+
+    except WebSocketDisconnect:
+        print(f"{username} disconnected from chat {chat_id}")
+
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        await manager.disconnect(connection) # and that we've gone, once our last tab has
+
+
+# -----------------------------------------------------------------------------------------
+# MULTIPLEXED ENDPOINT --------------------------------------------------------------------
+#
+# One socket per user for all their chats. Every frame is a JSON object (or a MessagePack
+# map on the msgpack subprotocol):
+#
+#   {"type": "subscribe", "chat_ids": [1, 2]}     -> {"type": "subscribed", "chat_ids": [...], "denied": [...]}
+#   {"type": "subscribe", "chat_ids": [1], "resume_from": {"1": 41}}   (replays chat 1 after seq 41)
+#   {"type": "unsubscribe", "chat_ids": [2]}      -> {"type": "unsubscribed", "chat_ids": [...]}
+#   {"type": "message", "chat_id": 1, "content": "hi"}
+#   {"type": "message", "chat_id": 1, "content": "hi", "client_msg_id": "c0ffee"}
+#                                                 -> {"type": "ack", "chat_id": 1, "client_msg_id": "c0ffee", "id": ..., "seq": ...}
+#                                                    once it's stored. Resending the same client_msg_id is safe
+#                                                    (see utils/sent_messages.py), /ws/{chat_id} takes the same frame as JSON text
+#   {"type": "read", "chat_id": 1, "seq": 41}     read up to seq 41 (/ws/{chat_id} takes {"type": "read", "seq": 41})
+#   {"type": "pong"}                              answer to the server's {"type": "ping"} heartbeats (after the
+#                                                 first one, a socket silent for WS_HEARTBEAT_TIMEOUT is dropped)
+#   {"type": "ping"}                              -> {"type": "pong"}
+#
+# Every subscribed chat starts with a {"type": "presence", "snapshot": true, ...} of who's online,
+# then gets presence diffs as that changes (see ConnectionManager).
+# Every event sent back carries its chat_id. Busy rooms send {"type": "batch", "chat_id": ..., "events": [...]}
+# instead of one frame per event. Problems come back as {"type": "error", "detail": ...}
+
+def _chat_ids(frame : dict) -> List[int]:
+    chat_ids = frame.get("chat_ids", [frame["chat_id"]] if "chat_id" in frame else [])
+    if not isinstance(chat_ids, list) or not all(isinstance(c, int) for c in chat_ids):
+        raise ValueError("chat_ids must be a list of integers")
+    return chat_ids
+
+def _resume_from(frame : dict) -> Dict[int, int]:
+    resume_from = frame.get("resume_from", {})
+    if not isinstance(resume_from, dict):
+        raise ValueError("resume_from must map chat ids to seqs")
+    try:
+        return {int(chat_id) : int(seq) for chat_id, seq in resume_from.items()} # JSON keys are strings
+    except (TypeError, ValueError):
+        raise ValueError("resume_from must map chat ids to seqs")
 
+async def subscribe(connection : Connection, chat_ids : List[int], resume_from : Dict[int, int]):
+    wanted = [chat_id for chat_id in dict.fromkeys(chat_ids) if chat_id not in connection.chat_ids]
+    if len(connection.chat_ids) + len(wanted) > WS_MAX_SUBSCRIPTIONS:
+        manager.send(connection, {"type" : "error", "detail" : f"At most {WS_MAX_SUBSCRIPTIONS} chats per connection"})
+        return
+
+    allowed = set()
+    if wanted:
+        _, allowed = await admission_cache.admit(connection.user_id, wanted)
+
+    joined = [chat_id for chat_id in wanted if chat_id in allowed]
+    for chat_id in joined:
+        await manager.join(connection, chat_id, resume_from.get(chat_id))
+
+    manager.send(connection, {
+        "type" : "subscribed",
+        "chat_ids" : sorted(connection.chat_ids),
+        "denied" : [chat_id for chat_id in wanted if chat_id not in allowed]
+    })
+
+async def unsubscribe(connection : Connection, chat_ids : List[int]):
+    for chat_id in chat_ids:
+        if chat_id in connection.chat_ids:
+            await manager.leave(connection, chat_id)
+
+    manager.send(connection, {"type" : "unsubscribed", "chat_ids" : sorted(connection.chat_ids)})
+
+@router.websocket("/ws")
+async def multiplexed_websocket_endpoint(
+    websocket : WebSocket,
+    token : str = Query(...)
+    ):
+
+    user_id = authenticate(token)
+    if user_id is None:
+        await websocket.close(code=4001, reason="Authentication failed")
+        return
+
+    username, _ = await admission_cache.admit(user_id)
+
+    connection = await manager.connect(websocket)
+    connection.user_id = user_id
+    connection.username = username or f"User {user_id}"
 
     try:
         while True:
-            data = await websocket.receive_text()
-            print(f"Received from user {username} in chat {chat_id}: {data}")
-
-            # broadcast to all connected clients
-            message = {
-                "type" : "message",
-                "sender" : username,
-                "content" : data,
-                "timestamp" : datetime.now(tz=pytz.timezone("Australia/Brisbane")).isoformat()
-            }
-
-            await manager.broadcast(json.dumps(message), chat_id)
-
-            new_message = Message(
-                chat_id = chat_id,
-                creator_id = user_id,
-                content = data,
-                time_sent = datetime.now(tz=pytz.timezone("Australia/Brisbane"))
-            )
-            db.add(new_message)
-            db.commit()
-            db.refresh(new_message)
+            frame = await receive_frame(websocket, connection.wire_format)
+            connection.touch()
+            try:
+                if isinstance(frame, str):
+                    frame = json.loads(frame)
+                if not isinstance(frame, dict):
+                    raise ValueError("frames must be objects")
+
+                kind = frame.get("type")
+                if await control(connection, frame):
+                    pass
+                elif kind == "subscribe":
+                    await subscribe(connection, _chat_ids(frame), _resume_from(frame))
+                elif kind == "unsubscribe":
+                    await unsubscribe(connection, _chat_ids(frame))
+                else:
+                    raise ValueError(f"unknown frame type '{kind}'")
+
+            except (ValueError, KeyError) as e: # JSONDecodeError is a ValueError
+                manager.send(connection, {"type" : "error", "detail" : str(e)})
 
     except WebSocketDisconnect:
-        print(f"{username} disconnected from chat {chat_id}")
+        print(f"{connection.username} disconnected")
 
     except Exception as e:
         print(f"Error: {e}")
     finally:
-         # Notify everyone that this user left
-        leave_message = {
-            "type": "user_left",
-            "content": f"{username} left the chat",
-            "timestamp": datetime.now(tz=pytz.timezone("Australia/Brisbane")).isoformat(),
-            "sender": "system"
-        }
-        manager.broadcast(json.dumps(leave_message), chat_id)
-        manager.disconnect(websocket, chat_id)
+        await manager.disconnect(connection)
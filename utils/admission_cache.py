@@ -0,0 +1,134 @@
+"""
+Membership and username cache for websocket admission.
+
+Every websocket connect checks that the user is in the chat and looks up their
+username. After a deploy every client reconnects at once, so the answers are
+kept for a while:
+
+(chat_id, user_id) -> is_member   ADMISSION_CACHE_TTL seconds if true,
+                                  ADMISSION_NEGATIVE_TTL if false
+user_id -> username               ADMISSION_CACHE_TTL seconds
+
+Each side holds at most ADMISSION_CACHE_MAX_ENTRIES, least recently used go first.
+The membership routes forget entries on this worker when they change a membership;
+other workers catch up once the TTL runs out, which is why it's kept short.
+"""
+import os, time
+from collections import OrderedDict
+from typing import Hashable, Iterable, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import select
+
+from database.database import session_scope
+from database.models import User
+from database.queries import member_chat_ids
+
+load_dotenv()
+
+ADMISSION_CACHE_TTL = float(os.getenv("ADMISSION_CACHE_TTL", "60"))
+ADMISSION_NEGATIVE_TTL = float(os.getenv("ADMISSION_NEGATIVE_TTL", "5"))
+ADMISSION_CACHE_MAX_ENTRIES = int(os.getenv("ADMISSION_CACHE_MAX_ENTRIES", "100000"))
+
+_MISSING = object()
+
+
+class _TTLCache:
+    """OrderedDict of key -> (value, expires at), oldest use first."""
+
+    def __init__(self, max_entries : int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Hashable, Tuple[object, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key : Hashable):
+        entry = self.entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return _MISSING
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key : Hashable, value, ttl : float):
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def pop(self, key : Hashable):
+        self.entries.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries" : len(self.entries),
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_rate" : round(self.hits / lookups, 4) if lookups else 0,
+        }
+
+
+class AdmissionCache:
+    def __init__(
+        self,
+        ttl : float = ADMISSION_CACHE_TTL,
+        negative_ttl : float = ADMISSION_NEGATIVE_TTL,
+        max_entries : int = ADMISSION_CACHE_MAX_ENTRIES
+        ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.members = _TTLCache(max_entries)
+        self.usernames = _TTLCache(max_entries)
+
+    async def admit(self, user_id : int, chat_ids : Iterable[int] = ()) -> Tuple[Optional[str], Set[int]]:
+        """
+        (username, the chat_ids user_id is a member of). Whatever isn't cached is
+        loaded in one session, held only for those queries.
+        """
+        chat_ids = list(chat_ids)
+        allowed = set()
+        unknown = []
+        for chat_id in chat_ids:
+            is_member = self.members.get((chat_id, user_id))
+            if is_member is _MISSING:
+                unknown.append(chat_id)
+            elif is_member:
+                allowed.add(chat_id)
+
+        username = self.usernames.get(user_id)
+        if username is _MISSING or unknown:
+            async with session_scope() as db:
+                if username is _MISSING:
+                    username = await db.scalar(select(User.username).where(User.id == user_id))
+                    if username is not None:
+                        self.usernames.put(user_id, username, self.ttl)
+                found = set(await member_chat_ids(db, user_id, unknown))
+
+            for chat_id in unknown:
+                is_member = chat_id in found
+                self.members.put((chat_id, user_id), is_member, self.ttl if is_member else self.negative_ttl)
+            allowed |= found
+
+        return username, allowed
+
+    def forget_member(self, chat_id : int, user_id : int):
+        """Call after a membership is created or deleted."""
+        self.members.pop((chat_id, user_id))
+
+    def forget_chat(self, chat_id : int):
+        """Call after a chat is deleted. Walks the whole cache, chats aren't deleted often."""
+        for key in [key for key in self.members.entries if key[0] == chat_id]:
+            self.members.pop(key)
+
+    def stats(self) -> dict:
+        return {
+            "members" : self.members.stats(),
+            "usernames" : self.usernames.stats(),
+        }
+
+
+admission_cache = AdmissionCache()
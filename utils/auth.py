@@ -3,6 +3,8 @@ from jose import JWTError, jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 
+from utils.token_cache import verified_tokens
+
 import os, dotenv
 
 # configuration
@@ -21,8 +23,13 @@ def create_access_token(data : dict):
     return encoded_jwt
 
 def verify_access_token(token : str):
+    # the same token comes back on every request, only decode it the first time (until it expires)
+    payload = verified_tokens.get(token)
+    if payload is not None:
+        return payload
     try:
         payload=jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        verified_tokens.put(token, payload)
         return payload
     except JWTError:
         raise HTTPException(
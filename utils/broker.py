@@ -0,0 +1,259 @@
+"""
+Pub/sub backends for websocket fan-out.
+
+The ConnectionManager publishes every room event through a broker instead of
+writing straight to its own sockets, so that a message sent on one uvicorn
+worker reaches sockets held by every other worker. Each worker only subscribes
+to the chats it currently has live sockets for.
+
+BROKER_BACKEND=memory   -> single process, events never leave the worker (default)
+BROKER_BACKEND=postgres -> LISTEN/NOTIFY on DATABASE_URL via asyncpg
+
+The broker also numbers events: publish() stamps every event with the chat's
+next sequence number ("seq", 1, 2, 3... per chat), so reconnecting clients can
+say which events they've already seen. The newest seq handed out (or, with the
+memory backend, reserved) lives in chat_summaries.last_seq, so a chat's seqs keep
+going up across restarts - a client never sees a number twice.
+"""
+import asyncio, json, os
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
+
+from database.queries import reserve_seqs
+from utils.debug_utils import logger
+
+load_dotenv()
+
+BROKER_BACKEND = os.getenv("BROKER_BACKEND", "memory")
+BROKER_SEQ_BLOCK = int(os.getenv("BROKER_SEQ_BLOCK", "100")) # seqs the memory backend reserves per db write
+
+# called with (chat_id, event) for every event that should go out to local sockets
+Handler = Callable[[int, dict], Awaitable[None]]
+
+# takes n more seqs for a chat, returns the newest one taken (None if the chat has no summary)
+SeqReserver = Callable[[int, int], Awaitable[Optional[int]]]
+
+
+class Broker:
+    """
+    Base class for broker backends.
+    publish() numbers an event and sends it to every worker subscribed to chat_id,
+    including this one. Every worker sees a chat's events in seq order.
+    """
+    def __init__(self):
+        self.handler: Optional[Handler] = None
+        self.subscriptions: Set[int] = set()
+
+    async def start(self, handler : Handler):
+        self.handler = handler
+
+    async def stop(self):
+        self.subscriptions.clear()
+
+    async def subscribe(self, chat_id : int):
+        self.subscriptions.add(chat_id)
+
+    async def unsubscribe(self, chat_id : int):
+        self.subscriptions.discard(chat_id)
+
+    async def publish(self, chat_id : int, event : dict) -> Optional[int]:
+        """Sets event["seq"] and returns it (None if numbering failed and the event only went out locally)."""
+        raise NotImplementedError
+
+    def fits(self, event : dict) -> bool:
+        """Whether event is small enough to reach every worker (senders reject messages that aren't)."""
+        return True
+
+    async def _deliver(self, chat_id : int, event : dict):
+        if self.handler is not None and chat_id in self.subscriptions:
+            await self.handler(chat_id, event)
+
+
+class InMemoryBroker(Broker):
+    """
+    Delivers straight back to this process. Only correct with a single worker.
+
+    Seqs are reserved from chat_summaries.last_seq BROKER_SEQ_BLOCK at a time and
+    handed out from memory - presence and read events take seqs too but aren't
+    stored, so counting on from the last stored message after a restart would reuse
+    numbers clients have already seen. A restart leaves a gap of at most a block
+    instead, which resume_from and the unread counts don't mind.
+    """
+    def __init__(self, reserve_seqs : Optional[SeqReserver] = None, block : int = BROKER_SEQ_BLOCK):
+        super().__init__()
+        self.reserve_seqs = reserve_seqs
+        self.block = block
+        # never dropped, two ints per chat are cheap and reloading could go backwards
+        self.seqs: Dict[int, int] = {}
+        self.reserved: Dict[int, int] = {} # chat_id -> highest seq we may hand out
+        self.lock = asyncio.Lock() # one reservation at a time
+
+    def _exhausted(self, chat_id : int) -> bool:
+        return chat_id not in self.seqs or self.seqs[chat_id] >= self.reserved[chat_id]
+
+    async def publish(self, chat_id : int, event : dict) -> Optional[int]:
+        try:
+            if self._exhausted(chat_id):
+                async with self.lock:
+                    if self._exhausted(chat_id): # another publish may have reserved while we waited
+                        await self._reserve(chat_id)
+            self.seqs[chat_id] += 1
+            event["seq"] = self.seqs[chat_id]
+        except Exception as e:
+            # db down etc. - still delivered, just unnumbered, and the next publish tries again
+            logger.error(f"reserving seqs failed for chat {chat_id} -> {e}")
+            event["seq"] = None
+        await self._deliver(chat_id, event)
+        return event["seq"]
+
+    async def _reserve(self, chat_id : int):
+        if self.reserve_seqs is None:
+            reserved = self.seqs.get(chat_id, 0) + self.block # nothing to persist to
+        else:
+            reserved = await self.reserve_seqs(chat_id, self.block)
+            if reserved is None:
+                reserved = self.seqs.get(chat_id, 0) + self.block # chat without a summary (being deleted)
+        self.seqs.setdefault(chat_id, reserved - self.block)
+        self.reserved[chat_id] = reserved
+
+
+class PostgresBroker(Broker):
+    """
+    Postgres LISTEN/NOTIFY backend, one channel per chat (chat_<id>).
+
+    The seq is bumped in chat_summaries and the NOTIFY sent in the same statement,
+    so notifications commit in seq order. The publishing worker gets its own event
+    back through LISTEN like everyone else rather than delivering it directly - that
+    costs a round trip but keeps every worker's view of a chat in the same order.
+    NOTIFY payloads are limited to 8000 bytes by Postgres.
+    """
+    MAX_PAYLOAD = 7999
+    SEQ_PREFIX = 20 # room for the "<seq>:" in front of the event
+
+    NEXT_SEQ = """
+        INSERT INTO chat_summaries (chat_id, last_seq) VALUES ($1, 1)
+        ON CONFLICT (chat_id) DO UPDATE SET last_seq = chat_summaries.last_seq + 1
+        RETURNING last_seq
+    """
+    # payload is "<seq>:<event json>"
+    PUBLISH = f"""
+        WITH s AS ({NEXT_SEQ})
+        SELECT s.last_seq, pg_notify($2, s.last_seq::text || ':' || $3) FROM s
+    """
+
+    def __init__(self, dsn : str):
+        super().__init__()
+        self.dsn = dsn
+        self.listen_conn = None
+        self.publish_pool = None
+        self.listening: Set[int] = set()
+        self.lock = asyncio.Lock() # asyncpg connections can't run two commands at once
+
+    @staticmethod
+    def channel(chat_id : int) -> str:
+        return f"chat_{chat_id}"
+
+    async def start(self, handler : Handler):
+        import asyncpg
+
+        await super().start(handler)
+        self.publish_pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=4)
+        await self._open_listener()
+
+    async def _open_listener(self):
+        import asyncpg
+
+        self.listen_conn = await asyncpg.connect(self.dsn)
+        self.listen_conn.add_termination_listener(self._on_listener_lost)
+        self.listening = set()
+        for chat_id in list(self.subscriptions):
+            await self._sync(chat_id)
+
+    def _on_listener_lost(self, conn):
+        if self.handler is None:
+            return # we're shutting down
+        logger.error("broker listener connection lost, reconnecting")
+        asyncio.get_running_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 0.5
+        while self.handler is not None:
+            try:
+                await self._open_listener()
+                return
+            except Exception as e:
+                logger.error(f"broker reconnect failed -> {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10)
+
+    async def stop(self):
+        self.handler = None
+        if self.listen_conn is not None:
+            await self.listen_conn.close()
+        if self.publish_pool is not None:
+            await self.publish_pool.close()
+        await super().stop()
+
+    def _on_notify(self, conn, pid, channel, payload):
+        seq, _, message = payload.partition(":")
+        chat_id = int(channel[len("chat_"):])
+        event = json.loads(message)
+        event["seq"] = int(seq)
+        # tasks start in creation order, so deliveries keep the notification order
+        asyncio.get_running_loop().create_task(self._deliver(chat_id, event))
+
+    async def _sync(self, chat_id : int):
+        """Bring LISTEN state for chat_id in line with self.subscriptions."""
+        async with self.lock:
+            if self.listen_conn is None or self.listen_conn.is_closed():
+                return
+            wanted = chat_id in self.subscriptions
+            if wanted and chat_id not in self.listening:
+                await self.listen_conn.add_listener(self.channel(chat_id), self._on_notify)
+                self.listening.add(chat_id)
+            elif not wanted and chat_id in self.listening:
+                await self.listen_conn.remove_listener(self.channel(chat_id), self._on_notify)
+                self.listening.discard(chat_id)
+
+    async def subscribe(self, chat_id : int):
+        await super().subscribe(chat_id)
+        await self._sync(chat_id)
+
+    async def unsubscribe(self, chat_id : int):
+        await super().unsubscribe(chat_id)
+        await self._sync(chat_id)
+
+    def fits(self, event : dict) -> bool:
+        return len(json.dumps(event).encode()) + self.SEQ_PREFIX <= self.MAX_PAYLOAD
+
+    async def publish(self, chat_id : int, event : dict) -> Optional[int]:
+        message = json.dumps(event)
+        try:
+            if len(message.encode()) + self.SEQ_PREFIX > self.MAX_PAYLOAD:
+                # chat messages are checked with fits() before they get here, this is for anything else
+                logger.error(f"event for chat {chat_id} too large for NOTIFY, only sent to local sockets")
+                event["seq"] = await self.publish_pool.fetchval(self.NEXT_SEQ, chat_id)
+                await self._deliver(chat_id, event)
+            else:
+                event["seq"] = await self.publish_pool.fetchval(self.PUBLISH, chat_id, self.channel(chat_id), message)
+        except Exception as e:
+            logger.error(f"NOTIFY failed for chat {chat_id} -> {e}")
+            event["seq"] = None
+            await self._deliver(chat_id, event) # unnumbered, but at least this worker's sockets get it
+        return event["seq"]
+
+
+def asyncpg_dsn(database_url : str) -> str:
+    """SQLAlchemy URLs carry a driver (postgresql+psycopg2://), asyncpg wants plain postgresql://"""
+    url = make_url(database_url).set(drivername="postgresql")
+    return url.render_as_string(hide_password=False)
+
+
+def create_broker(backend : str = BROKER_BACKEND) -> Broker:
+    if backend == "memory":
+        return InMemoryBroker(reserve_seqs)
+    if backend == "postgres":
+        return PostgresBroker(asyncpg_dsn(os.getenv("DATABASE_URL")))
+    raise ValueError(f"Unknown BROKER_BACKEND '{backend}'")
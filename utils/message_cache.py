@@ -0,0 +1,170 @@
+"""
+Recent-messages ring buffers for chats that are live on this worker.
+
+ChatOut.initial_messages is the last few messages of a chat. For chats the
+ConnectionManager has sockets for, every message already passes through this
+process on the broadcast path, so we keep the tail in memory and the REST
+routes can skip the database for hot rooms.
+
+Only live chats are cached - a worker that isn't subscribed to a chat doesn't
+see its broadcasts, so anything it cached would go stale. Rooms are hydrated
+from the database on the first read, and least recently used rooms are emptied
+once RECENT_CACHE_MAX_BYTES (a rough estimate, not exact accounting) is reached.
+"""
+import os
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Sequence
+
+import pytz
+from dotenv import load_dotenv
+
+from database.queries import INITIAL_MESSAGES, latest_messages_by_chat
+import utils.pydantic_models as models
+
+load_dotenv()
+
+RECENT_CACHE_MAX_BYTES = int(os.getenv("RECENT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+MESSAGE_OVERHEAD = 400 # rough size of a MessageOut + its deque slot, on top of the strings
+
+BRISBANE = pytz.timezone("Australia/Brisbane")
+
+
+def message_size(message : models.MessageOut) -> int:
+    return MESSAGE_OVERHEAD + len(message.sender) + len(message.contents) + len(message.timestamp)
+
+
+def timestamp_key(timestamp : str) -> float:
+    # both live events and db rows go through queries.format_timestamp, so these carry an
+    # offset - naive ones are treated as Brisbane time just in case
+    sent = datetime.fromisoformat(timestamp)
+    if sent.tzinfo is None:
+        sent = BRISBANE.localize(sent)
+    return sent.timestamp()
+
+
+class _Room:
+    __slots__ = ("messages", "hydrated", "size")
+
+    def __init__(self, per_chat : int):
+        self.messages: Deque[models.MessageOut] = deque(maxlen=per_chat)
+        self.hydrated = False # False until loaded from the db, appends still collect meanwhile
+        self.size = 0
+
+
+class RecentMessageCache:
+    def __init__(self, per_chat : int = INITIAL_MESSAGES, max_bytes : int = RECENT_CACHE_MAX_BYTES):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+
+        self.rooms: Dict[int, _Room] = {} # every live chat
+        self.lru: "OrderedDict[int, None]" = OrderedDict() # live chats holding messages, oldest use first
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def track(self, chat_id : int):
+        """Chat became live on this worker - start collecting its broadcasts."""
+        if chat_id not in self.rooms:
+            self.rooms[chat_id] = _Room(self.per_chat)
+
+    def drop(self, chat_id : int):
+        """Chat is no longer live - we'd miss its messages from now on."""
+        room = self.rooms.pop(chat_id, None)
+        if room is not None:
+            self.size -= room.size
+            self.lru.pop(chat_id, None)
+
+    def _clear(self, chat_id : int):
+        room = self.rooms[chat_id]
+        self.size -= room.size
+        room.messages.clear()
+        room.size = 0
+        room.hydrated = False
+        self.lru.pop(chat_id, None)
+
+    def _enforce_cap(self):
+        while self.size > self.max_bytes and self.lru:
+            chat_id = next(iter(self.lru))
+            self._clear(chat_id)
+            self.evictions += 1
+
+    def _push(self, room : _Room, message : models.MessageOut):
+        if len(room.messages) == room.messages.maxlen:
+            oldest = message_size(room.messages[0])
+            room.size -= oldest
+            self.size -= oldest
+        room.messages.append(message)
+        room.size += message_size(message)
+        self.size += message_size(message)
+
+    def append(self, chat_id : int, message : models.MessageOut):
+        """Called on the broadcast path for every chat message delivered to this worker."""
+        room = self.rooms.get(chat_id)
+        if room is None:
+            return
+        self._push(room, message)
+        self.lru[chat_id] = None
+        self.lru.move_to_end(chat_id)
+        self._enforce_cap()
+
+    def _hydrate(self, chat_id : int, loaded : List[models.MessageOut]):
+        room = self.rooms[chat_id]
+        # anything broadcast before this load that's newer than the newest row in the db
+        # just hasn't been flushed by the message writer yet
+        newest = timestamp_key(loaded[-1].timestamp) if loaded else None
+        pending = [m for m in room.messages if newest is None or timestamp_key(m.timestamp) > newest]
+
+        self.size -= room.size
+        room.messages.clear()
+        room.size = 0
+        for message in loaded + pending:
+            self._push(room, message)
+        room.hydrated = True
+        self.lru[chat_id] = None
+        self.lru.move_to_end(chat_id)
+
+    async def get_many(self, db, chat_ids : Sequence[int]) -> Dict[int, List[models.MessageOut]]:
+        """The latest messages for each chat, from memory where possible and one db query for the rest."""
+        result: Dict[int, List[models.MessageOut]] = {}
+        missing = []
+
+        for chat_id in chat_ids:
+            room = self.rooms.get(chat_id)
+            if room is not None and room.hydrated:
+                self.hits += 1
+                result[chat_id] = list(room.messages)
+                self.lru.move_to_end(chat_id)
+            else:
+                self.misses += 1
+                missing.append(chat_id)
+
+        if missing:
+            loaded = await latest_messages_by_chat(db, missing, self.per_chat)
+            for chat_id, messages in loaded.items():
+                if chat_id in self.rooms and not self.rooms[chat_id].hydrated:
+                    self._hydrate(chat_id, messages)
+                    result[chat_id] = list(self.rooms[chat_id].messages)
+                else:
+                    result[chat_id] = messages
+            self._enforce_cap()
+
+        return result
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "live_chats" : len(self.rooms),
+            "cached_chats" : len(self.lru),
+            "approx_bytes" : self.size,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_rate" : round(self.hits / lookups, 4) if lookups else 0,
+            "evictions" : self.evictions,
+        }
+
+
+recent_messages = RecentMessageCache()
@@ -0,0 +1,174 @@
+"""
+Per-socket outbound queues.
+
+Every websocket gets a bounded queue and its own writer task, so broadcasting
+to a room is just an enqueue per socket and one stalled client can't hold up
+delivery to everyone else. When a client falls behind and its queue fills up,
+WS_SLOW_CONSUMER_POLICY decides what happens:
+
+drop_oldest -> throw away the oldest queued event to make room (default)
+disconnect  -> close the socket, the client reconnects and catches up over REST
+"""
+import asyncio, os, time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Set
+
+from fastapi import WebSocket
+from dotenv import load_dotenv
+
+from utils.debug_utils import logger
+from utils.wire import Frame, JSON
+
+load_dotenv()
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", DROP_OLDEST)
+
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+class Connection:
+    """
+    Everything the server keeps per socket. Slotted and with a bare deque for the queue
+    (the writer parks on a single future instead of an asyncio.Queue's machinery),
+    since a worker can hold a lot of these.
+    """
+    __slots__ = (
+        "websocket", "policy", "wire_format", "max_queue", "queue", "wakeup", "writer_task",
+        "closed", "dropped", "on_evict", "held", "last_seen", "heartbeats", "user_id", "username", "chat_ids",
+    )
+
+    def __init__(
+        self,
+        websocket : WebSocket,
+        max_queue : int = WS_SEND_QUEUE_SIZE,
+        policy : str = WS_SLOW_CONSUMER_POLICY,
+        wire_format : str = JSON,
+        on_evict : Optional[Callable[["Connection"], None]] = None
+        ):
+        if policy not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy '{policy}'")
+
+        self.websocket = websocket
+        self.policy = policy
+        self.wire_format = wire_format
+        self.max_queue = max_queue
+        self.queue: Deque[Frame] = deque()
+        self.wakeup: Optional[asyncio.Future] = None # set while the writer waits for frames
+        self.writer_task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.dropped = 0 # events thrown away under drop_oldest
+        self.on_evict = on_evict
+        self.held: Optional[List[Frame]] = None # live frames parked while a resume replay is queued
+        self.last_seen = time.monotonic() # last time the client sent us anything
+        self.heartbeats = False # set once the client pings/pongs - only then is silence a dead peer
+
+        self.user_id: Optional[int] = None
+        self.username = ""
+        self.chat_ids: Set[int] = set() # rooms this socket is in
+
+    def start(self):
+        self.writer_task = asyncio.get_running_loop().create_task(self._writer())
+
+    def touch(self):
+        """Call for every frame received, any traffic proves the client is still there."""
+        self.last_seen = time.monotonic()
+
+    def hold(self):
+        """Park live frames instead of queueing them, so a replay can go out ahead of them."""
+        if self.held is None:
+            self.held = []
+
+    def release(self, replayed : Dict[int, Optional[int]]):
+        """
+        Queue the parked frames, skipping any the replay already covered.
+        replayed maps chat_id -> last seq replayed for that chat (None to skip nothing).
+        """
+        held, self.held = self.held or [], None
+        for frame in held:
+            last = replayed.get(frame.event.get("chat_id"))
+            if last is None:
+                self.enqueue(frame)
+            elif frame.event.get("type") == "batch":
+                events = [event for event in frame.event["events"] if event.get("seq") is None or event["seq"] > last]
+                if len(events) == len(frame.event["events"]):
+                    self.enqueue(frame)
+                elif events:
+                    self.enqueue(Frame({**frame.event, "events" : events}))
+            elif frame.event.get("seq") is None or frame.event["seq"] > last:
+                self.enqueue(frame)
+
+    def enqueue(self, frame : Frame) -> bool:
+        """Queue a frame without waiting. Returns False if the connection is (now) closed."""
+        if self.held is not None and not self.closed:
+            self.held.append(frame)
+            return True
+        return self.enqueue_now(frame)
+
+    def enqueue_now(self, frame : Frame) -> bool:
+        """enqueue(), ignoring any hold."""
+        if self.closed:
+            return False
+
+        if 0 < self.max_queue <= len(self.queue): # 0 = unbounded, like asyncio.Queue
+            if self.policy == DISCONNECT:
+                return self._evict()
+            self.queue.popleft()
+            self.dropped += 1
+
+        self.queue.append(frame)
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+        return True
+
+    def _evict(self) -> bool:
+        logger.warning("evicting slow websocket consumer")
+        self.closed = True
+        if self.on_evict is not None:
+            self.on_evict(self)
+        asyncio.get_running_loop().create_task(
+            self.close(code=SLOW_CONSUMER_CLOSE_CODE, reason="Slow consumer")
+        )
+        return False
+
+    async def _writer(self):
+        try:
+            while True:
+                if not self.queue:
+                    self.wakeup = asyncio.get_running_loop().create_future()
+                    await self.wakeup
+                    self.wakeup = None
+                    continue
+                frame = self.queue.popleft()
+                data = frame.encoded(self.wire_format) # only the first socket per format actually encodes
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # dead socket - the receive loop will notice and clean up
+            logger.info(f"websocket writer stopped -> {e}")
+            self.closed = True
+
+    async def stop(self):
+        """Stop the writer task. Anything still queued is discarded."""
+        self.closed = True
+        self.queue.clear()
+        if self.writer_task is not None and not self.writer_task.done():
+            self.writer_task.cancel()
+            try:
+                await self.writer_task
+            except asyncio.CancelledError:
+                pass
+
+    async def close(self, code : int = 1000, reason : str = ""):
+        await self.stop()
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass # already closed
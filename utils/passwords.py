@@ -0,0 +1,153 @@
+"""
+Argon2 hashing and verification in a process pool of its own.
+
+Each hash/verify burns tens of ms of CPU and argon2's memory_cost worth of memory
+(64MiB by default). Run in the route thread pool, a login burst holds every thread
+and the GIL, and unrelated sync routes queue behind it. Here they go to
+PASSWORD_HASH_WORKERS processes instead, so a burst uses the cores without touching
+the event loop or the thread pool, and the pool size caps the memory argon2 can take.
+Every uvicorn worker gets its own pool, so with several set PASSWORD_HASH_WORKERS to
+roughly cores / uvicorn workers. The workers are spawned, not forked, which means a
+script that starts the app in-process needs an if __name__ == "__main__" guard.
+
+Admission control: at most PASSWORD_HASH_MAX_PENDING calls are let in (running plus
+queued). Past that a request gets a 503 with Retry-After straight away - waiting
+behind a long queue would only time the client out anyway.
+"""
+import asyncio, multiprocessing, os, time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from utils.debug_utils import logger
+
+load_dotenv()
+
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8)))
+PASSWORD_HASH_RETRY_AFTER = 1 # seconds, sent back with the 503
+
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+
+
+# these run in the worker processes, so they have to be plain module-level functions
+def _hash(password : str) -> str:
+    return pwd_context.hash(password)
+
+def _verify(password : str, password_hash : str) -> bool:
+    return pwd_context.verify(password, password_hash)
+
+def _warm():
+    return None
+
+
+class PasswordHasher:
+    def __init__(self, workers : int = PASSWORD_HASH_WORKERS, max_pending : int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.in_flight = 0 # admitted and not finished yet, only touched on the event loop
+
+        # metrics
+        self.hashed = 0
+        self.verified = 0
+        self.rejected = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+        self.total_ms = 0.0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            # spawn, not fork - forking a process with the event loop and db threads running isn't safe
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self.pool
+
+    def _replace(self, broken : ProcessPoolExecutor):
+        """Swap out a broken pool - once, however many calls it failed at the same time."""
+        if self.pool is not broken:
+            return # someone who hit it first already did
+        logger.error("password hashing pool broke, restarting it")
+        self.pool = None
+        broken.shutdown(wait=False, cancel_futures=True) # the broken pool's processes are already gone, nothing to wait for
+
+    async def start(self):
+        """Start the workers now so the first logins don't pay for spawning them."""
+        loop = asyncio.get_running_loop()
+        pool = self._pool()
+        await asyncio.gather(*(loop.run_in_executor(pool, _warm) for _ in range(self.workers)))
+
+    async def stop(self):
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await asyncio.get_running_loop().run_in_executor(None, pool.shutdown)
+
+    async def hash(self, password : str) -> str:
+        password_hash = await self._run(_hash, password)
+        self.hashed += 1
+        return password_hash
+
+    async def verify(self, password : str, password_hash : str) -> bool:
+        ok = await self._run(_verify, password, password_hash)
+        self.verified += 1
+        return ok
+
+    async def _run(self, fn, *args):
+        if self.in_flight >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins right now, try again shortly",
+                headers={"Retry-After" : str(PASSWORD_HASH_RETRY_AFTER)}
+            )
+
+        self.in_flight += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth())
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            pool = self._pool()
+            try:
+                return await loop.run_in_executor(pool, fn, *args)
+            except BrokenProcessPool:
+                # a worker died (oom killed etc.) and took the pool with it - start a fresh one and go again
+                self._replace(pool)
+                return await loop.run_in_executor(self._pool(), fn, *args)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.last_ms = elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            self.total_ms += elapsed_ms
+
+    def queue_depth(self) -> int:
+        """Calls waiting for a free worker."""
+        return max(0, self.in_flight - self.workers)
+
+    def stats(self) -> dict:
+        done = self.hashed + self.verified + self.failed
+        return {
+            "workers" : self.workers,
+            "in_flight" : self.in_flight,
+            "queue_depth" : self.queue_depth(),
+            "max_queue_depth" : self.max_queue_depth,
+            "max_pending" : self.max_pending,
+            "hashed" : self.hashed,
+            "verified" : self.verified,
+            "rejected" : self.rejected,
+            "failed" : self.failed,
+            "last_ms" : round(self.last_ms, 3),
+            "max_ms" : round(self.max_ms, 3),
+            "avg_ms" : round(self.total_ms / done, 3) if done else 0,
+        }
+
+
+password_hasher = PasswordHasher()
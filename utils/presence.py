@@ -0,0 +1,138 @@
+"""
+Who's online, per chat.
+
+The tracker counts live sockets per (chat_id, user_id), so a user with three tabs
+open is one online member, and only reports changes:
+
+- a user comes online with their first socket in the chat
+- they go offline PRESENCE_GRACE_MS after their last socket closes, unless one
+  comes back first - a phone flapping between networks doesn't announce anything
+- changes are collected per room and handed to on_change at most once every
+  PRESENCE_FLUSH_MS, with anything that cancelled out inside the window dropped
+
+online(chat_id) is who's online right now, announced(chat_id) who the room has been
+told about so far - a snapshot of that plus every diff after it is the live list.
+Both come from memory in O(online members). Counts are per worker: with several
+workers each one announces and answers for its own sockets.
+"""
+import asyncio, os
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PRESENCE_GRACE_MS = int(os.getenv("PRESENCE_GRACE_MS", "3000"))
+PRESENCE_FLUSH_MS = int(os.getenv("PRESENCE_FLUSH_MS", "1000"))
+
+# called with (chat_id, came online {user_id: username}, went offline {user_id: username})
+ChangeHandler = Callable[[int, Dict[int, str], Dict[int, str]], None]
+
+
+class _RoomPresence:
+    __slots__ = ("sockets", "usernames", "leaving", "announced", "changed", "flush", "last_flush")
+
+    def __init__(self):
+        self.sockets: Dict[int, int] = {} # user_id -> live sockets
+        self.usernames: Dict[int, str] = {} # everyone online, including users in their grace period
+        self.leaving: Dict[int, asyncio.TimerHandle] = {} # users down to 0 sockets, in their grace period
+        self.announced: Dict[int, str] = {} # who the room has been told is online
+        self.changed: Set[int] = set() # users whose state may differ from announced
+        self.flush: Optional[asyncio.TimerHandle] = None
+        self.last_flush = float("-inf")
+
+    def idle(self) -> bool:
+        return not self.usernames and not self.announced and self.flush is None
+
+
+class PresenceTracker:
+    def __init__(
+        self,
+        on_change : ChangeHandler,
+        grace_ms : int = PRESENCE_GRACE_MS,
+        flush_ms : int = PRESENCE_FLUSH_MS
+        ):
+        self.on_change = on_change
+        self.grace = grace_ms / 1000
+        self.flush_interval = flush_ms / 1000
+        self.rooms: Dict[int, _RoomPresence] = {}
+
+    def connected(self, chat_id : int, user_id : int, username : str):
+        room = self.rooms.get(chat_id)
+        if room is None:
+            room = self.rooms[chat_id] = _RoomPresence()
+
+        room.sockets[user_id] = room.sockets.get(user_id, 0) + 1
+        if room.sockets[user_id] > 1:
+            return # another tab
+
+        room.usernames[user_id] = username
+        pending = room.leaving.pop(user_id, None)
+        if pending is not None:
+            pending.cancel() # back inside the grace period, nothing to announce
+            return
+        self._changed(chat_id, room, user_id)
+
+    def disconnected(self, chat_id : int, user_id : int):
+        room = self.rooms.get(chat_id)
+        if room is None or user_id not in room.sockets:
+            return
+
+        room.sockets[user_id] -= 1
+        if room.sockets[user_id] > 0:
+            return
+        del room.sockets[user_id]
+        room.leaving[user_id] = asyncio.get_running_loop().call_later(self.grace, self._expire, chat_id, user_id)
+
+    def _expire(self, chat_id : int, user_id : int):
+        room = self.rooms.get(chat_id)
+        if room is None or room.leaving.pop(user_id, None) is None:
+            return
+        del room.usernames[user_id]
+        self._changed(chat_id, room, user_id)
+
+    def _changed(self, chat_id : int, room : _RoomPresence, user_id : int):
+        room.changed.add(user_id)
+        if room.flush is None:
+            loop = asyncio.get_running_loop()
+            delay = max(0.0, room.last_flush + self.flush_interval - loop.time())
+            room.flush = loop.call_later(delay, self._flush, chat_id)
+
+    def _flush(self, chat_id : int):
+        room = self.rooms.get(chat_id)
+        if room is None:
+            return
+        room.flush = None
+        room.last_flush = asyncio.get_running_loop().time()
+
+        came_online, went_offline = {}, {}
+        for user_id in room.changed:
+            if user_id in room.usernames:
+                if user_id not in room.announced:
+                    came_online[user_id] = room.announced[user_id] = room.usernames[user_id]
+            elif user_id in room.announced:
+                went_offline[user_id] = room.announced.pop(user_id)
+        room.changed.clear()
+
+        if room.idle():
+            del self.rooms[chat_id]
+
+        if came_online or went_offline:
+            self.on_change(chat_id, came_online, went_offline)
+
+    def online(self, chat_id : int) -> List[Tuple[int, str]]:
+        """(user_id, username) for everyone online in chat_id on this worker."""
+        room = self.rooms.get(chat_id)
+        return list(room.usernames.items()) if room is not None else []
+
+    def announced(self, chat_id : int) -> List[Tuple[int, str]]:
+        """Like online(), but as of the last change handed to on_change."""
+        room = self.rooms.get(chat_id)
+        return list(room.announced.items()) if room is not None else []
+
+    def stats(self) -> dict:
+        return {
+            "rooms" : len(self.rooms),
+            "online" : sum(len(room.usernames) for room in self.rooms.values()),
+            "in_grace" : sum(len(room.leaving) for room in self.rooms.values()),
+        }
@@ -1,4 +1,5 @@
 from pydantic import BaseModel, model_validator, field_validator
+from typing import Optional
 
 # Users
 class UserIn(BaseModel):
@@ -35,10 +36,16 @@ class MessageCreate(BaseModel):
     contents : str
 
 class MessageOut(BaseModel):
+    id : Optional[int] = None
     type : str = "message"
     sender : str
     contents : str
     timestamp : str
+    seq : Optional[int] = None # per-chat broadcast sequence number, usable as a websocket resume_from
+
+class MessagePage(BaseModel):
+    messages : list[MessageOut]
+    next_cursor : Optional[int] = None # pass back as before_id/after_id for the next page
 
 # Chats
 class Member(BaseModel):
@@ -55,6 +62,10 @@ class ChatOut(BaseModel):
     members : list[Member] = []
     initial_messages : list[MessageOut]
     id : int
+    message_count : int = 0
+    last_activity : Optional[str] = None
+    unread : int = 0 # other people's messages after the read cursor, at most 99
+    unread_capped : bool = False # true -> there are more than that, show "99+"
 
 
 class ChatCreate(BaseModel):
@@ -66,6 +77,19 @@ class ChatIn(BaseModel):
     new_name : str
     pinned : bool
 
+class UnreadCount(BaseModel):
+    chat_id : int
+    unread : int
+    capped : bool = False
+
+class OnlineMember(BaseModel):
+    id : int
+    username : str
+
+class PresenceOut(BaseModel):
+    chat_id : int
+    online : list[OnlineMember] = []
+
 
 
 # Chats
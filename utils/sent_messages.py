@@ -0,0 +1,78 @@
+"""
+Recently sent client message ids, per user, so retried sends aren't sent twice.
+
+Clients tag messages with a client_msg_id and resend until they get an ack. For
+the last CLIENT_MSG_ID_WINDOW ids of each user this worker remembers what happened
+to them - a resend of one still being written just waits for the same ack, a resend
+of one that's stored is acked straight away. Neither is broadcast again.
+
+Anything older, or first sent to another worker, is caught by the message writer
+against the unique (creator_id, client_msg_id) index instead: not stored twice, but
+broadcast again, so clients drop events whose client_msg_id they've already shown.
+At most CLIENT_MSG_ID_MAX_USERS users are remembered, least recently sending go first.
+"""
+import os
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CLIENT_MSG_ID_WINDOW = int(os.getenv("CLIENT_MSG_ID_WINDOW", "256"))
+CLIENT_MSG_ID_MAX_USERS = int(os.getenv("CLIENT_MSG_ID_MAX_USERS", "100000"))
+CLIENT_MSG_ID_MAX_LENGTH = 64 # messages.client_msg_id
+
+
+class Sent:
+    __slots__ = ("chat_id", "message_id", "seq", "waiters")
+
+    def __init__(self, chat_id : int):
+        self.chat_id = chat_id
+        self.message_id: Optional[int] = None # set once it's stored
+        self.seq: Optional[int] = None
+        self.waiters: List[object] = [] # connections to ack once it's stored
+
+
+class SentMessages:
+    def __init__(self, window : int = CLIENT_MSG_ID_WINDOW, max_users : int = CLIENT_MSG_ID_MAX_USERS):
+        self.window = window
+        self.max_users = max_users
+        self.users: "OrderedDict[int, OrderedDict[str, Sent]]" = OrderedDict()
+        self.duplicates = 0
+
+    def claim(self, user_id : int, client_msg_id : str, chat_id : int) -> Tuple[Sent, bool]:
+        """(entry, True) for an id we haven't seen, (its earlier entry, False) for a resend."""
+        sent = self.users.get(user_id)
+        if sent is None:
+            sent = self.users[user_id] = OrderedDict()
+            while len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+
+        entry = sent.get(client_msg_id)
+        if entry is not None:
+            self.duplicates += 1
+            return entry, False
+
+        entry = sent[client_msg_id] = Sent(chat_id)
+        while len(sent) > self.window:
+            sent.popitem(last=False) # a pending one still gets its ack, the writer's callback holds on to it
+        return entry, True
+
+    def forget(self, user_id : int, client_msg_id : str):
+        """The message couldn't be stored - let a resend go through from scratch."""
+        sent = self.users.get(user_id)
+        if sent is not None:
+            sent.pop(client_msg_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "users" : len(self.users),
+            "ids" : sum(len(sent) for sent in self.users.values()),
+            "duplicates" : self.duplicates,
+        }
+
+
+sent_messages = SentMessages()
@@ -0,0 +1,128 @@
+"""
+Time-ordered ids, so a message has its final id before it's written.
+
+    | 41 bits: ms since SNOWFLAKE_EPOCH | 6 bits: worker id | 6 bits: sequence |
+
+53 bits in all, so they're still exact as JavaScript numbers (Number.MAX_SAFE_INTEGER
+is 2^53 - 1) - clients and the API keep treating ids and cursors as plain integers.
+Ids from one worker always increase, and ids from different workers sort by the
+millisecond they were made in (k-sorted), so ORDER BY id is send order to within
+clock skew. 41 bits of milliseconds lasts ~69 years from the epoch, and each worker
+can make 64 ids per ms - past that it borrows the next millisecond rather than wait.
+
+Every process needs its own worker id (0-63) - two processes sharing one can hand
+out the same id. SNOWFLAKE_WORKER_ID sets it explicitly. Unset, on Postgres each process
+leases a free one at startup (worker_id_lease, a session advisory lock held for as long
+as the process runs). Anywhere else it's the low 6 bits of the pid, which is only safe
+for a single process - pids 64 apart collide.
+"""
+import asyncio, os, threading, time
+from typing import Optional
+
+from dotenv import load_dotenv
+from sqlalchemy.engine import make_url
+
+from utils.debug_utils import logger
+
+load_dotenv()
+
+SNOWFLAKE_EPOCH_MS = 1767225600000 # 2026-01-01T00:00:00Z
+WORKER_ID_BITS = 6
+SEQUENCE_BITS = 6
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+SNOWFLAKE_WORKER_ID = os.getenv("SNOWFLAKE_WORKER_ID") # None -> leased at startup
+SNOWFLAKE_LEASE_NAMESPACE = 0x5f1a # first key of the advisory locks, keeps them apart from any others
+
+
+class Snowflake:
+    def __init__(self, worker_id : int = os.getpid() & MAX_WORKER_ID, epoch_ms : int = SNOWFLAKE_EPOCH_MS):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self.epoch_ms = epoch_ms
+        self.last_ms = -1
+        self.sequence = 0
+        self.lock = threading.Lock() # the event loop and the sync route threads can both ask
+
+    def next_id(self) -> int:
+        with self.lock:
+            now = time.time_ns() // 1_000_000 - self.epoch_ms
+            if now > self.last_ms:
+                self.last_ms = now
+                self.sequence = 0
+            else:
+                # same ms, or the clock stepped back - keep counting from the last ms so ids never go backwards
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    self.last_ms += 1 # 64 already this ms, borrow the next one
+            return (self.last_ms << (WORKER_ID_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+
+def id_time_ms(snowflake_id : int, epoch_ms : int = SNOWFLAKE_EPOCH_MS) -> int:
+    """Unix ms an id was made in."""
+    return (snowflake_id >> (WORKER_ID_BITS + SEQUENCE_BITS)) + epoch_ms
+
+
+class WorkerIdLease:
+    """
+    Holds one of the 64 worker ids for this process with pg_try_advisory_lock, on a
+    connection of its own. If that connection drops the lock goes with it, so it's
+    taken again (the same id if it's still free) - until then ids keep coming from
+    the old one, the window is a reconnect long.
+    """
+    def __init__(self, snowflake : Snowflake, database_url : Optional[str] = None):
+        self.snowflake = snowflake
+        self.database_url = database_url or os.getenv("DATABASE_URL")
+        self.conn = None
+        self.stopping = False
+
+    async def start(self):
+        if SNOWFLAKE_WORKER_ID is not None:
+            self.snowflake.worker_id = int(SNOWFLAKE_WORKER_ID)
+            return
+        if make_url(self.database_url).get_backend_name() != "postgresql":
+            logger.warning(f"SNOWFLAKE_WORKER_ID isn't set - using {self.snowflake.worker_id} from the pid, only safe for one process")
+            return
+        await self._acquire(self.snowflake.worker_id)
+
+    async def stop(self):
+        self.stopping = True
+        if self.conn is not None:
+            await self.conn.close() # releases the lock
+
+    async def _acquire(self, preferred : int):
+        import asyncpg
+        from utils.broker import asyncpg_dsn
+
+        conn = await asyncpg.connect(asyncpg_dsn(self.database_url))
+        for worker_id in [preferred] + [i for i in range(MAX_WORKER_ID + 1) if i != preferred]:
+            if await conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", SNOWFLAKE_LEASE_NAMESPACE, worker_id):
+                self.snowflake.worker_id = worker_id
+                self.conn = conn
+                conn.add_termination_listener(self._lost)
+                return
+        await conn.close()
+        raise RuntimeError(f"all {MAX_WORKER_ID + 1} snowflake worker ids are leased")
+
+    def _lost(self, conn):
+        if self.stopping:
+            return
+        logger.error(f"snowflake worker id {self.snowflake.worker_id} lease lost, taking it again")
+        asyncio.get_running_loop().create_task(self._reacquire())
+
+    async def _reacquire(self):
+        delay = 0.5
+        while not self.stopping:
+            try:
+                await self._acquire(self.snowflake.worker_id)
+                return
+            except Exception as e:
+                logger.error(f"snowflake worker id lease failed -> {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10)
+
+
+snowflake = Snowflake()
+worker_id_lease = WorkerIdLease(snowflake)
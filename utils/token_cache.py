@@ -0,0 +1,91 @@
+"""
+Verified access tokens, so a token is only checked once until it expires.
+
+Clients send the same bearer token on every REST call and websocket connect, and
+each one was a full jwt.decode - base64, HMAC check, JSON, claims. Once a token has
+verified, its payload is kept under the token's sha256 digest until the token's own
+exp, so a cached answer is never one jwt.decode wouldn't also give. Tokens without an
+exp aren't cached. Failures aren't either - garbage tokens can't push good ones out.
+
+At most JWT_CACHE_MAX_ENTRIES tokens, least recently used go first (0 turns the cache
+off). The sync dependencies run on the thread pool, hence the lock.
+"""
+import hashlib, os, threading, time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+JWT_CACHE_MAX_ENTRIES = int(os.getenv("JWT_CACHE_MAX_ENTRIES", "100000"))
+
+
+def _digest(token : str) -> bytes:
+    return hashlib.sha256(token.encode()).digest() # fixed size, and the raw tokens don't sit in memory
+
+
+class VerifiedTokens:
+    def __init__(self, max_entries : int = JWT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[bytes, Tuple[dict, float]]" = OrderedDict() # digest -> (payload, exp)
+        self.lock = threading.Lock()
+
+        # metrics
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def get(self, token : str) -> Optional[dict]:
+        """The payload of a verified, unexpired token, None if it has to be verified. Don't modify it, it's shared."""
+        key = _digest(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= time.time():
+                del self.entries[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token : str, payload : dict):
+        exp = payload.get("exp")
+        if self.max_entries <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = _digest(token)
+        with self.lock:
+            self.entries[key] = (payload, exp)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+
+    def forget(self, token : str):
+        """Stop trusting one token (e.g. on logout) - it's verified from scratch next time."""
+        with self.lock:
+            self.entries.pop(_digest(token), None)
+
+    def clear(self):
+        """Forget everything, e.g. after SECRET_KEY changes."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries" : len(self.entries),
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "hit_rate" : round(self.hits / lookups, 4) if lookups else 0,
+            "expired" : self.expired,
+            "evicted" : self.evicted,
+        }
+
+
+verified_tokens = VerifiedTokens()
@@ -0,0 +1,121 @@
+"""
+Unread counts for a user's chats.
+
+counts() answers from memory for chats that are live on this worker (some socket
+here is subscribed, so every message and read receipt passes through the manager)
+and from one database query (database/queries.py unread_counts) for the rest.
+
+For a live chat the first count comes from the manager's replay window when it
+reaches back to the user's cursor, and is then kept up to date as events are
+delivered: +1 per message from someone else, reset when a read receipt moves the
+cursor. Entries are dropped with the chat when this worker stops listening to it.
+Counts stop at cap + 1, shown as "99+".
+"""
+from typing import Deque, Dict, Iterable, Set
+
+from database.queries import UNREAD_COUNT_CAP, unread_counts
+from database.read_cursors import read_cursors
+from utils.wire import Frame
+
+
+class _Unread:
+    __slots__ = ("cursor", "count")
+
+    def __init__(self, cursor : int, count : int):
+        self.cursor = cursor
+        self.count = count
+
+
+class UnreadCounts:
+    def __init__(self, replay : Dict[int, Deque[Frame]], cap : int = UNREAD_COUNT_CAP):
+        self.replay = replay # the manager's replay windows - a chat is live while it has one
+        self.cap = cap
+        self.chats: Dict[int, Dict[int, _Unread]] = {} # chat_id -> user_id -> count
+        self.users: Dict[int, Set[int]] = {} # user_id -> chat_ids with an entry
+        self.memory_answers = 0
+        self.query_answers = 0
+
+    async def counts(self, db, user_id : int) -> Dict[int, int]:
+        """chat_id -> unread (at most cap + 1) for every chat user_id is a member of."""
+        # held onto, the chat can stop being live while the query runs
+        cached = {chat_id : self.chats[chat_id][user_id] for chat_id in self.users.get(user_id, ())}
+        rows = await unread_counts(db, user_id, read_cursors.pending_for(user_id), list(cached), self.cap)
+
+        counts = {}
+        for chat_id, cursor, count in rows:
+            if count is None: # in skip
+                counts[chat_id] = cached[chat_id].count
+                self.memory_answers += 1
+                continue
+            self.query_answers += 1
+            counts[chat_id] = count
+
+            window = self._window(chat_id, cursor)
+            if window is not None:
+                # exact even for messages the writer hasn't flushed yet
+                counts[chat_id] = self._count(window, user_id, cursor)
+                self._put(chat_id, user_id, _Unread(cursor, counts[chat_id]))
+        return counts
+
+    def _window(self, chat_id : int, cursor : int):
+        """The chat's replay window if it covers everything after cursor, else None."""
+        window = self.replay.get(chat_id)
+        if not window or window[0].event["seq"] > cursor + 1:
+            return None
+        return window
+
+    def _count(self, window : Iterable[Frame], user_id : int, cursor : int) -> int:
+        count = 0
+        for frame in window:
+            event = frame.event
+            if event["seq"] > cursor and event.get("type") == "message" and event.get("sender_id") != user_id:
+                count += 1
+                if count > self.cap:
+                    break
+        return count
+
+    def _put(self, chat_id : int, user_id : int, entry : _Unread):
+        self.chats.setdefault(chat_id, {})[user_id] = entry
+        self.users.setdefault(user_id, set()).add(chat_id)
+
+    def _forget(self, chat_id : int, user_id : int):
+        users = self.chats.get(chat_id, {})
+        users.pop(user_id, None)
+        if not users:
+            self.chats.pop(chat_id, None)
+        chat_ids = self.users.get(user_id)
+        if chat_ids is not None:
+            chat_ids.discard(chat_id)
+            if not chat_ids:
+                del self.users[user_id]
+
+    def message(self, chat_id : int, sender_id : int, seq : int):
+        """A message was delivered to live chat chat_id."""
+        for user_id, entry in self.chats.get(chat_id, {}).items():
+            if user_id != sender_id and seq > entry.cursor and entry.count <= self.cap:
+                entry.count += 1
+
+    def read(self, chat_id : int, user_id : int, seq : int):
+        """user_id's read cursor in chat_id moved to seq."""
+        entry = self.chats.get(chat_id, {}).get(user_id)
+        if entry is None or seq <= entry.cursor:
+            return
+        window = self._window(chat_id, seq)
+        if window is None:
+            self._forget(chat_id, user_id) # back to the db next time
+            return
+        entry.cursor = seq
+        entry.count = self._count(window, user_id, seq)
+
+    def drop(self, chat_id : int):
+        """chat_id is no longer live on this worker - its counts would go stale."""
+        for user_id in list(self.chats.get(chat_id, ())):
+            self._forget(chat_id, user_id)
+
+    def stats(self) -> dict:
+        return {
+            "live_chats" : len(self.chats),
+            "entries" : sum(len(users) for users in self.chats.values()),
+            "memory_answers" : self.memory_answers,
+            "query_answers" : self.query_answers,
+        }
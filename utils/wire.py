@@ -0,0 +1,80 @@
+"""
+Websocket wire formats.
+
+Clients pick a format with the websocket subprotocol header:
+
+    new WebSocket(url, ["msgpack", "json"])
+
+json    -> JSON text frames (default, and what you get with no subprotocol)
+msgpack -> MessagePack binary frames, only offered if the msgpack package is installed
+
+Broadcast events are wrapped in a Frame, which encodes the event at most once
+per format no matter how many sockets in the room use it.
+"""
+import json
+from typing import Optional, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+try:
+    import msgpack
+except ImportError: # optional dependency
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+SUPPORTED_FORMATS = (JSON, MSGPACK) if msgpack is not None else (JSON,)
+
+
+def negotiate(websocket : WebSocket) -> Optional[str]:
+    """The first subprotocol the client offered that we support, or None if it didn't ask for one we know."""
+    for offered in websocket.scope.get("subprotocols", []):
+        if offered in SUPPORTED_FORMATS:
+            return offered
+    return None
+
+
+def encode(event : dict, wire_format : str) -> Union[str, bytes]:
+    if wire_format == MSGPACK:
+        return msgpack.packb(event, use_bin_type=True)
+    return json.dumps(event)
+
+
+def decode(data : Union[str, bytes], wire_format : str):
+    if isinstance(data, bytes):
+        if wire_format != MSGPACK:
+            raise ValueError("binary frames need the msgpack subprotocol")
+        return msgpack.unpackb(data, raw=False)
+    return data
+
+
+async def receive_frame(websocket : WebSocket, wire_format : str):
+    """Like websocket.receive_text(), but also takes binary frames from msgpack clients."""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+
+    if message.get("text") is not None:
+        return message["text"]
+    return decode(message["bytes"], wire_format)
+
+
+class Frame:
+    """A broadcast event plus its encodings, filled in lazily and shared by every socket."""
+    __slots__ = ("event", "_json", "_msgpack")
+
+    def __init__(self, event : dict):
+        self.event = event
+        self._json: Optional[str] = None
+        self._msgpack: Optional[bytes] = None
+
+    def encoded(self, wire_format : str) -> Union[str, bytes]:
+        if wire_format == MSGPACK:
+            if self._msgpack is None:
+                self._msgpack = encode(self.event, MSGPACK)
+            return self._msgpack
+
+        if self._json is None:
+            self._json = encode(self.event, JSON)
+        return self._json